@@ -0,0 +1,771 @@
+#!/usr/bin/env python3
+"""Micro-benchmarks for the hot paths of huion_keys.py.
+
+Run `python bench.py --help` for the list of benchmarks.
+"""
+import os
+import sys
+import gc
+import json
+import time
+import random
+import argparse
+import tempfile
+import threading
+import subprocess
+import logging
+
+import huion_keys
+
+# a pen motion report, which is what the tablet sends almost all of the time
+PEN_REPORT = bytes.fromhex('08800a1b0c1d00000000ff00')
+BUTTON_DOWN_REPORT = bytes.fromhex('f7e001010100000000000000')
+BUTTON_UP_REPORT = bytes.fromhex('f7e001010000000000000000')
+HERE = os.path.dirname(os.path.abspath(__file__))
+DUMPS = [os.path.join(HERE, 'huion_dump.txt'), os.path.join(HERE, 'raw_button_data.txt')]
+
+
+def make_stream(count, pen_ratio=50):
+    """Builds `count` reports where only one in `pen_ratio` is not pen motion."""
+    reports = []
+    for i in range(count):
+        if i % pen_ratio == 0:
+            reports.append(BUTTON_DOWN_REPORT if (i // pen_ratio) % 2 == 0 else BUTTON_UP_REPORT)
+        else:
+            reports.append(PEN_REPORT)
+    return b''.join(reports)
+
+
+def load_dump(path):
+    """Parses a hexdump like raw_button_data.txt into a list of 12-byte reports."""
+    reports = []
+    with open(path) as dump:
+        for line in dump:
+            line = line.split('#', 1)[0].strip()
+            if not line:
+                continue
+            if ':' in line:
+                # drop the "00000000:" offset printed by xxd
+                line = line.split(':', 1)[1].strip()
+            report = bytes.fromhex(''.join(line.split()[:6]))
+            if len(report) == huion_keys.REPORT_SIZE:
+                reports.append(report)
+    return reports
+
+
+def read_old(path, count):
+    """The original read path: one buffered read(12) and one new bytes per report."""
+    with open(path, 'rb') as hidraw:
+        for _ in range(count):
+            sequence = hidraw.read(huion_keys.REPORT_SIZE)
+            if sequence[1] == 0xe0 and sequence[4] > 0:
+                pass
+
+
+def read_new(path, count):
+    reader = huion_keys.ReportReader(open(path, 'rb', buffering=0))
+    sequence = reader.buffer
+    remaining = count
+    while remaining:
+        reader.fill()
+        for i in range(reader.offset, reader.end, huion_keys.REPORT_SIZE):
+            if sequence[i + 1] == 0xe0 and sequence[i + 4] > 0:
+                pass
+        remaining -= (reader.end - reader.offset) // huion_keys.REPORT_SIZE
+    reader.close()
+
+
+def count_allocations(path, count, old):
+    """Counts memory blocks still alive right after reports have been read."""
+    getblocks = sys.getallocatedblocks
+    # calibrate for the ints created by getallocatedblocks() itself
+    baseline = 0
+    for _ in range(1000):
+        before = getblocks()
+        baseline += getblocks() - before
+    baseline /= 1000
+    total = 0
+    if old:
+        with open(path, 'rb') as hidraw:
+            for _ in range(count):
+                before = getblocks()
+                sequence = hidraw.read(huion_keys.REPORT_SIZE)
+                total += getblocks() - before
+                del sequence
+    else:
+        reader = huion_keys.ReportReader(open(path, 'rb', buffering=0))
+        sequence = reader.buffer
+        done = 0
+        while done < count:
+            before = getblocks()
+            reader.fill()
+            for i in range(reader.offset, reader.end, huion_keys.REPORT_SIZE):
+                report_type = sequence[i + 1]
+            total += getblocks() - before
+            done += (reader.end - reader.offset) // huion_keys.REPORT_SIZE
+        reader.close()
+        count = done
+    return max(total / count - baseline, 0.0)
+
+
+def bench_reads(args):
+    with tempfile.NamedTemporaryFile(delete=False) as stream:
+        stream.write(make_stream(args.count))
+    try:
+        for name, func, old in (('read(12)', read_old, True), ('readinto', read_new, False)):
+            start = time.perf_counter()
+            func(stream.name, args.count)
+            elapsed = time.perf_counter() - start
+            allocs = count_allocations(stream.name, min(args.count, 100000), old)
+            print("%-10s %12.0f reports/s %8.3f allocs/report" % (name, args.count / elapsed, allocs))
+    finally:
+        os.unlink(stream.name)
+
+
+class OldDecoder(object):
+    """The original if-chain from PollThread.get_button_press, for comparison."""
+
+    BUTTON_BITS = {1 << bit: bit + 1 for bit in range(8)}
+
+    scroll_state = None
+
+    def decode(self, sequence):
+        if sequence[1] == 0xe0:
+            if sequence[4] > 0:
+                return self.BUTTON_BITS[sequence[4]]
+            elif sequence[5] > 0:
+                return self.BUTTON_BITS[sequence[5]] + 8
+        elif sequence[1] == 0xf0:
+            scroll_pos = sequence[5]
+            if scroll_pos == 0:
+                self.scroll_state = None
+            elif self.scroll_state is not None:
+                if scroll_pos > self.scroll_state:
+                    self.scroll_state = scroll_pos
+                    return 'scroll_down'
+                elif scroll_pos < self.scroll_state:
+                    self.scroll_state = scroll_pos
+                    return 'scroll_up'
+            else:
+                self.scroll_state = scroll_pos
+        elif sequence[1] == 0xf1:
+            if sequence[5] == 0x1:
+                return 'dial_cw'
+            elif sequence[5] == 0xff:
+                return 'dial_ccw'
+        return None
+
+
+def bench_decode(args):
+    reports = []
+    for report in load_dump(args.dump):
+        reports.append(report)
+        reports.extend([PEN_REPORT] * args.pen)
+    repeats = max(args.count // len(reports), 1)
+    count = repeats * len(reports)
+    old = OldDecoder()
+    start = time.perf_counter()
+    for _ in range(repeats):
+        for sequence in reports:
+            old.decode(sequence)
+    old_elapsed = time.perf_counter() - start
+
+    stream = bytearray(b''.join(reports))
+    decoder = huion_keys.ReportDecoder()
+    decode = decoder.decode
+    size = huion_keys.REPORT_SIZE
+    start = time.perf_counter()
+    for _ in range(repeats):
+        for i in range(0, len(stream), size):
+            decode(stream, i)
+    new_elapsed = time.perf_counter() - start
+    results = [('if-chain', old_elapsed), ('tables', new_elapsed)]
+
+    # whole reads at a time, like Tablet.process()
+    batch = size * huion_keys.READ_BATCH
+    reads = [bytearray(stream[i:i + batch]) for i in range(0, len(stream), batch)]
+    decoders = [('batched', huion_keys.ReportDecoder())]
+    if huion_keys.load_filter():
+        decoders.append(('native', huion_keys.NativeReportDecoder()))
+    else:
+        print("_huion_filter isn't built, run xdo_build.py --filter-only to compare")
+    for name, decoder in decoders:
+        decode_all = decoder.decode_all
+        start = time.perf_counter()
+        for _ in range(repeats):
+            for read in reads:
+                decode_all(read, 0, len(read))
+        results.append((name, time.perf_counter() - start))
+
+    print("%d reports from %s" % (count, args.dump))
+    for name, elapsed in results:
+        print("%-10s %12.0f reports/s %8.1f ns/report" % (name, count / elapsed, elapsed / count * 1e9))
+
+
+def random_report(rng):
+    """Returns a 12-byte report that is mostly buttons, strip and dial, with the odd pen report."""
+    report = bytearray(rng.getrandbits(8) for _ in range(huion_keys.REPORT_SIZE))
+    report[1] = rng.choice((0xe0, 0xe0, 0xf0, 0xf0, 0xf1, 0x80, rng.getrandbits(8)))
+    if rng.random() < 0.8:
+        # few distinct values, so that buttons repeat and strip positions compare equal
+        report[4] = rng.choice((0, 0, 0x01, 0x02, 0x03, 0x80))
+        report[5] = rng.choice((0, 0, 0x01, 0xff, 0x02, 0x05, 0x07, 0x80))
+    return report
+
+
+def bench_native(args):
+    if not huion_keys.load_filter():
+        print("_huion_filter isn't built, run xdo_build.py --filter-only to check it")
+        return 0
+    rng = random.Random(args.seed)
+    size = huion_keys.REPORT_SIZE
+    batches = 0
+    for run in range(args.runs):
+        # a fresh pair per run, so the state is compared across many reads
+        python, native = huion_keys.ReportDecoder(), huion_keys.NativeReportDecoder()
+        buffer = bytearray(size * huion_keys.READ_BATCH)
+        for _ in range(args.batches):
+            count = rng.randint(0, huion_keys.READ_BATCH)
+            for i in range(count):
+                buffer[i * size:(i + 1) * size] = random_report(rng)
+            # like a read that starts after reports that were handed out already
+            start = rng.randint(0, count) * size
+            expected = python.decode_all(buffer, start, count * size)
+            got = native.decode_all(buffer, start, count * size)
+            batches += 1
+            if got != expected:
+                print("run %d: the reports %s" % (run, buffer[start:count * size].hex()))
+                print("decoded in Python to %r" % (expected,))
+                print("decoded in C to      %r" % (got,))
+                return 1
+    print("%d batches of random reports decoded the same in C and Python" % (batches,))
+    return 0
+
+
+BUTTONS_CONFIG = """
+[Bindings]
+1=a
+2=b
+1+2=c
+4=d
+4.long=e
+4.double=f
+
+[Hold]
+3=ctrl
+
+[Gestures]
+long=%(long)d
+double=%(double)d
+"""
+
+
+class RecordingEmitter(object):
+    """Stands in for the Emitter and writes down what the tablet asked it to send."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.sent = []
+
+    def record(self, action, keysequence):
+        with self.lock:
+            self.sent.append((action, keysequence.decode('utf-8')))
+
+    def send(self, keysequence, stamp=None):
+        self.record('send', keysequence)
+
+    def move(self, keysequence, stamp=None):
+        self.record('move', keysequence)
+
+    def key_down(self, keysequence, stamp=None):
+        self.record('down', keysequence)
+
+    def key_up(self, keysequence, stamp=None):
+        self.record('up', keysequence)
+
+
+def bench_buttons(args):
+    long_press_time, double_tap_time = args.long / 1000.0, args.double / 1000.0
+    # long enough for a gesture to resolve on the 10 ms scheduler tick
+    settle = max(long_press_time, double_tap_time) + 0.1
+    with tempfile.TemporaryDirectory() as directory:
+        config_file = os.path.join(directory, 'huion_keys.conf')
+        with open(config_file, 'w') as config:
+            config.write(BUTTONS_CONFIG % {'long': args.long, 'double': args.double})
+        huion_keys.set_bindings(huion_keys.read_config(config_file))
+    # (name, steps, what should be sent), a step is a button number, negative
+    # for its release, or None to wait for the gestures to resolve
+    cases = [
+        ('press', [1, -1], [('send', 'a')]),
+        ('chord', [1, 2, -2, -1], [('send', 'c')]),
+        ('not a chord', [2, -2, 1, -1], [('send', 'b'), ('send', 'a')]),
+        ('chord while holding', [3, 1, 2, -2, -1, -3],
+         [('down', 'ctrl'), ('send', 'c'), ('up', 'ctrl')]),
+        ('tap', [4, -4, None], [('send', 'd')]),
+        ('long press', [4, None, -4], [('send', 'e')]),
+        ('double tap', [4, -4, 4, -4, None], [('send', 'f')]),
+        ('unplugged while holding', [3, 'close'], [('down', 'ctrl'), ('up', 'ctrl')]),
+    ]
+    failed = 0
+    for name, steps, expected in cases:
+        tablet = huion_keys.Tablet('/dev/null')
+        emitter = RecordingEmitter()
+        for step in steps:
+            if step is None:
+                time.sleep(settle)
+            elif step == 'close':
+                tablet.close(emitter)
+            else:
+                tablet.handle(huion_keys.ButtonEvent(abs(step), step > 0), emitter)
+        time.sleep(settle)
+        if emitter.sent == expected:
+            print("%-26s ok" % (name,))
+        else:
+            print("%-26s sent %r, expected %r" % (name, emitter.sent, expected))
+            failed += 1
+    return 1 if failed else 0
+
+
+class NullBackend(object):
+    """Output backend that sends nothing, so the Emitter never talks to X."""
+
+    def check(self, keysequence):
+        pass
+
+    def open(self):
+        pass
+
+    def close(self):
+        pass
+
+    def tap(self, keysequence, repeat=1):
+        pass
+
+    def key_down(self, keysequence):
+        pass
+
+    def key_up(self, keysequence):
+        pass
+
+    def check_text(self, text):
+        pass
+
+    def check_click(self, button):
+        pass
+
+    def type_text(self, text):
+        pass
+
+    def click(self, button):
+        pass
+
+
+class FlakyBackend(NullBackend):
+    """NullBackend whose connection breaks after every `every` actions."""
+
+    def __init__(self, every):
+        self.every = every
+        self.actions = 0
+        self.opened = 0
+        self.closed = 0
+
+    def open(self):
+        self.opened += 1
+
+    def close(self):
+        self.closed += 1
+
+    def tap(self, keysequence, repeat=1):
+        self.actions += 1
+        if self.actions % self.every == 0:
+            raise OSError("the connection broke")
+
+
+def bind_everything():
+    """Gives every button, the scroll strip and the dial a binding."""
+    buttons = {button: b'button%d' % (button,) for button in range(1, 17)}
+    for name in huion_keys.RELATIVE_EVENTS:
+        buttons[name] = name.encode('utf-8')
+    huion_keys.BINDINGS = huion_keys.BINDINGS._replace(buttons=buttons)
+
+
+def replay_stream(args):
+    """Builds the replayed stream from the dumps, with pen reports interleaved."""
+    reports = []
+    for dump in args.dump or DUMPS:
+        for report in load_dump(dump):
+            reports.append(report)
+            reports.extend([PEN_REPORT] * args.pen)
+    cycle = b''.join(reports)
+    repeats = max(args.count // len(reports), 1)
+    return cycle * repeats, repeats * len(reports)
+
+
+def feed(stream, chunk):
+    """Forks a writer that feeds stream into a pipe, returns the read end's path and the pid."""
+    read_fd, write_fd = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(read_fd)
+        size = chunk * huion_keys.REPORT_SIZE
+        view = memoryview(stream)
+        for offset in range(0, len(stream), size):
+            os.write(write_fd, view[offset:offset + size])
+        os._exit(0)
+    os.close(write_fd)
+    return '/proc/%d/fd/%d' % (os.getpid(), read_fd), read_fd, pid
+
+
+def bench_replay(args):
+    stream, count = replay_stream(args)
+    bind_everything()
+    # logging is part of the cost, but not of the output
+    huion_keys.setup_logging(getattr(logging, args.log_level.upper()), open(os.devnull, 'w'))
+    emitter = huion_keys.Emitter(NullBackend())
+    huion_keys.STATS = huion_keys.Stats(emitter)
+    emitter.start()
+    path, read_fd, pid = feed(stream, args.chunk)
+    wall = time.perf_counter()
+    cpu = time.process_time()
+    if args.engine == 'selector':
+        engine = huion_keys.SelectorEngine(emitter)
+        engine.add(path)
+        engine.run()
+    else:
+        huion_keys.PollThread(path, emitter).run()
+    emitter.stop()
+    emitter.join()
+    cpu = time.process_time() - cpu
+    wall = time.perf_counter() - wall
+    os.close(read_fd)
+    os.waitpid(pid, 0)
+
+    stats = huion_keys.STATS
+    read_to_inject = huion_keys.Histogram()
+    for histogram in stats.bindings.values():
+        for index, bucket in enumerate(histogram.counts):
+            read_to_inject.counts[index] += bucket
+        read_to_inject.count += histogram.count
+        read_to_inject.max = max(read_to_inject.max, histogram.max)
+    results = {
+        'reports': count,
+        'reports_per_second': count / wall,
+        'cpu_ns_per_report': cpu / count * 1e9,
+        'keys_emitted': emitter.emitted,
+    }
+    for percent in stats.PERCENTILES:
+        results['p%s_us' % (percent,)] = read_to_inject.percentile(percent) / 1000.0
+    print("%d reports (%d pen reports per dump report), %s engine, %d reports per write" % (
+        count, args.pen, args.engine, args.chunk))
+    stats.dump()
+    report(results, args)
+
+
+def report(results, args):
+    """Prints results, compared to --baseline if given, and saves them with --save."""
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+    for key, value in results.items():
+        line = "%-20s %14.1f" % (key, value)
+        if baseline and baseline.get(key):
+            line += "   %+7.1f%% vs baseline" % ((value / baseline[key] - 1) * 100,)
+        print(line)
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+def bench_output(args):
+    # keysyms of ctrl+shift+z, so that the config doesn't need an X server
+    keysequence = b'ctrl+shift+z'
+    huion_keys.KEYSYMS[keysequence] = (0xffe3, 0xffe1, ord('z'))
+    backend = huion_keys.UinputBackend(file=open(args.file or os.devnull, 'wb', buffering=0))
+    backend.open()
+    for repeat in (1, 8):
+        start = time.perf_counter()
+        for _ in range(args.count):
+            backend.tap(keysequence, repeat)
+        elapsed = time.perf_counter() - start
+        print("uinput  %d tap(s) per write %10.0f writes/s %8.2f us/write" % (
+            repeat, args.count / elapsed, elapsed / args.count * 1e6))
+    backend.close()
+
+
+def write_big_config(path, modes):
+    """Writes a config that binds everything, with the given number of dial modes."""
+    keys = ['ctrl+z', 'ctrl+shift+z', 'ctrl+s', 'bracketleft', 'bracketright', 'ctrl+minus',
+            'ctrl+shift+equal', 'alt+Tab', 'super+F4', 'shift+Page_Up', 'KP_Add', 'Escape']
+    lines = ['[Bindings]']
+    for button in range(1, 17):
+        lines.append('%d=%s' % (button, keys[button % len(keys)]))
+    lines += ['scroll_up=Up', 'scroll_down=Down', '[Hold]', '15=ctrl', '16=shift',
+              '[Relative]', 'window=20', '[Dial]', 'cycle=1']
+    for mode in range(1, modes + 1):
+        lines.append('[Mode %d]' % (mode,))
+        for index, name in enumerate(sorted(huion_keys.RELATIVE_EVENTS)):
+            lines.append('%s=%s' % (name, keys[(mode + index) % len(keys)]))
+        for button in range(2, 15):
+            lines.append('%d=ctrl+alt+%s' % (button, keys[(mode * button) % len(keys)]))
+    with open(path, 'w') as config:
+        config.write('\n'.join(lines) + '\n')
+
+
+def bench_startup(args):
+    backend = NullBackend()
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'huion_keys.conf')
+        write_big_config(path, args.modes)
+        cache = path + huion_keys.CONFIG_CACHE_SUFFIX
+        # warm up the key name aliases, they are loaded once per process either way
+        huion_keys.parse_keysequence(b'ctrl')
+        for name in ('cold', 'warm'):
+            start = time.perf_counter()
+            for _ in range(args.count):
+                if name == 'cold' and os.path.exists(cache):
+                    os.unlink(cache)
+                huion_keys.KEYSYMS.clear()
+                bindings = huion_keys.load_bindings(path, backend)
+            elapsed = time.perf_counter() - start
+            print("%-5s %8.1f us/load" % (name, elapsed / args.count * 1e6))
+        print("%d modes, %d bindings, %d bytes of config, %d bytes of cache" % (
+            bindings.cycle_modes, sum(1 for _ in huion_keys.all_bindings(bindings)),
+            os.path.getsize(path), os.path.getsize(cache)))
+
+
+def import_times(code):
+    """Runs code in a new interpreter with -X importtime, returns {module: (self us, cumulative us)}."""
+    env = dict(os.environ, PYTHONPATH=HERE)
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', code], env=env,
+                            stdout=subprocess.DEVNULL, stderr=subprocess.PIPE,
+                            universal_newlines=True, check=True)
+    times = {}
+    for line in result.stderr.splitlines():
+        # "import time:   self [us] | cumulative | imported package"
+        if not line.startswith('import time:') or 'imported package' in line:
+            continue
+        own, cumulative, name = line[len('import time:'):].split('|')
+        times[name.strip()] = (int(own), int(cumulative))
+    return times
+
+
+def bench_imports(args):
+    # the first run writes the bytecode cache, like any install would have
+    import_times('import huion_keys')
+    runs = [import_times('import huion_keys') for _ in range(args.count)]
+    median = lambda values: sorted(values)[len(values) // 2]
+    total = median([times['huion_keys'][1] for times in runs])
+    print("import huion_keys, median of %d runs: %.1f ms" % (args.count, total / 1000.0))
+    slowest = sorted(runs[0].items(), key=lambda item: item[1][0], reverse=True)[:args.top]
+    for name, (own, cumulative) in slowest:
+        print("  %-30s %8.1f ms self %8.1f ms cumulative" % (name, own / 1000.0, cumulative / 1000.0))
+    for module in ('_xdo_cffi', 'asyncio'):
+        if module in runs[0]:
+            print("  %s should not be imported until it is needed" % (module,))
+    start = time.perf_counter()
+    for _ in range(args.count):
+        subprocess.run([sys.executable, os.path.join(HERE, 'huion_keys.py'), '--rules'],
+                       stdout=subprocess.DEVNULL, check=True)
+    rules = (time.perf_counter() - start) / args.count
+    report({'import_ms': total / 1000.0, 'rules_ms': rules * 1000.0}, args)
+
+
+def bench_timers(args):
+    scheduler = huion_keys.Scheduler()
+    lateness = huion_keys.Histogram()
+    done = threading.Event()
+    fired = [0]
+    expected = args.count - args.count // 2
+
+    def fire(due):
+        lateness.record(max(time.perf_counter_ns() - due, 0))
+        fired[0] += 1
+        if fired[0] == expected:
+            done.set()
+
+    # nothing comes due before every timer has been added and cancelled
+    delays = [args.lead + args.spread * (i + 1) / args.count for i in range(args.count)]
+    start = time.perf_counter()
+    timers = [scheduler.call_later(delay, fire, time.perf_counter_ns() + int(delay * 1e9))
+              for delay in delays]
+    scheduled = time.perf_counter()
+    # like gestures that resolved before their timer went off
+    for timer in timers[1::2]:
+        timer.cancel()
+    cancelled = time.perf_counter()
+    done.wait(args.lead + args.spread + 5)
+    print("%d timers over %.1f s: call_later %.2f us, cancel %.2f us, %d fired" % (
+        args.count, args.spread, (scheduled - start) / args.count * 1e6,
+        (cancelled - scheduled) / (args.count // 2) * 1e6, fired[0]))
+    print("late by (ms): p50 %.1f, p99 %.1f, max %.1f, the tick is %.0f ms" % (
+        lateness.percentile(50) / 1e6, lateness.percentile(99) / 1e6, lateness.max / 1e6,
+        scheduler.TICK * 1000))
+    return 0 if fired[0] == expected else 1
+
+
+def resources():
+    """Returns (open fds, threads, live objects) of this process."""
+    gc.collect()
+    return len(os.listdir('/proc/self/fd')), threading.active_count(), len(gc.get_objects())
+
+
+def cycle_devices(emitter, reports, cycles):
+    """Plugs a tablet in, replays reports through it and unplugs it, `cycles` times."""
+    for _ in range(cycles):
+        read_fd, write_fd = os.pipe()
+        thread = huion_keys.PollThread('/proc/self/fd/%d' % (read_fd,), emitter)
+        thread.start()
+        os.write(write_fd, reports)
+        os.close(write_fd)
+        thread.join()
+        os.close(read_fd)
+    while not emitter.queue.empty():
+        time.sleep(0.01)
+
+
+def bench_leak(args):
+    bind_everything()
+    # every reconnect would be logged
+    huion_keys.LOG.setLevel(logging.ERROR)
+    reports = b''.join(load_dump(os.path.join(HERE, 'raw_button_data.txt')))
+    backend = FlakyBackend(args.break_every)
+    emitter = huion_keys.Emitter(backend)
+    emitter.start()
+    # the first rounds allocate caches that are kept on purpose
+    cycle_devices(emitter, reports, 5)
+    before = resources()
+    start = time.perf_counter()
+    cycle_devices(emitter, reports, args.cycles)
+    elapsed = time.perf_counter() - start
+    emitter.shutdown(None)
+    after = resources()
+    print("%d device cycles in %.1f s, %d keys emitted, output opened %d times, closed %d times" % (
+        args.cycles, elapsed, emitter.emitted, backend.opened, backend.closed))
+    leaks = []
+    if backend.opened != backend.closed:
+        leaks.append("%d output connections were never closed" % (backend.opened - backend.closed,))
+
+    if args.output != 'null':
+        # open and close the real output the same way the Emitter does on reconnects
+        backend = huion_keys.OUTPUT_BACKENDS[args.output]()
+        backend.open()
+        backend.close()
+        fds = len(os.listdir('/proc/self/fd'))
+        for _ in range(args.cycles):
+            backend.open()
+            backend.close()
+        print("%s output opened and closed %d times" % (args.output, args.cycles))
+        if len(os.listdir('/proc/self/fd')) != fds:
+            leaks.append("%s output leaked %d fds" % (args.output, len(os.listdir('/proc/self/fd')) - fds))
+
+    names = ('open fds', 'threads', 'live objects')
+    for name, old, new in zip(names, before, after):
+        print("%-14s %8d -> %8d" % (name, old, new))
+    if after[0] != before[0]:
+        leaks.append("%d fds leaked" % (after[0] - before[0],))
+    if after[1] > before[1]:
+        leaks.append("%d threads leaked" % (after[1] - before[1],))
+    # a few objects come and go, a leak grows with the number of cycles
+    if after[2] - before[2] > args.cycles // 2:
+        leaks.append("%d objects leaked" % (after[2] - before[2],))
+    for leak in leaks:
+        print("LEAK: %s" % (leak,))
+    return 1 if leaks else 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmarks for huion_keys.py')
+    subparsers = parser.add_subparsers(dest='bench', required=True)
+    reads = subparsers.add_parser('reads', help='hidraw read path: read(12) vs readinto()')
+    reads.add_argument('-n', '--count', type=int, default=1000000,
+                    help='number of reports to read')
+    reads.set_defaults(func=bench_reads)
+    decode = subparsers.add_parser('decode', help='report decoder over a captured dump')
+    decode.add_argument('-n', '--count', type=int, default=1000000,
+                    help='approximate number of reports to decode')
+    decode.add_argument('--dump', default=os.path.join(HERE, 'raw_button_data.txt'),
+                    help='hexdump of reports to decode (default: raw_button_data.txt)')
+    decode.add_argument('--pen', type=int, default=0,
+                    help='pen reports to interleave after every report of the dump')
+    decode.set_defaults(func=bench_decode)
+    buttons = subparsers.add_parser('buttons',
+                    help='check what presses, chords, holds, taps, long presses and double taps send')
+    buttons.add_argument('--long', type=int, default=100,
+                    help='long press time in ms')
+    buttons.add_argument('--double', type=int, default=100,
+                    help='double tap time in ms')
+    buttons.set_defaults(func=bench_buttons)
+    native = subparsers.add_parser('native',
+                    help='check that the C pre-filter decodes random reports like ReportDecoder')
+    native.add_argument('--runs', type=int, default=200,
+                    help='number of fresh decoder pairs')
+    native.add_argument('--batches', type=int, default=50,
+                    help='reads per run')
+    native.add_argument('--seed', type=int, default=1,
+                    help='seed of the random reports')
+    native.set_defaults(func=bench_native)
+    replay = subparsers.add_parser('replay',
+                    help='replay the captured dumps through a fake hidraw pipe, the decoder '
+                         'and the dispatch path with a no-op injection backend')
+    replay.add_argument('-n', '--count', type=int, default=200000,
+                    help='approximate number of reports to replay')
+    replay.add_argument('--dump', action='append',
+                    help='hexdump to replay, can be repeated (default: both dumps in the repo)')
+    replay.add_argument('--pen', type=int, default=20,
+                    help='pen reports to interleave after every report of the dumps')
+    replay.add_argument('--chunk', type=int, default=1,
+                    help='reports per write() into the pipe (hidraw delivers 1)')
+    replay.add_argument('--engine', choices=('threads', 'selector'), default='threads')
+    replay.add_argument('--log-level', choices=('debug', 'info'), default='info',
+                    help='log level to replay with, debug logs every event')
+    replay.add_argument('--save', help='write the results as JSON to this file')
+    replay.add_argument('--baseline', help='compare against results saved with --save')
+    replay.set_defaults(func=bench_replay)
+    output = subparsers.add_parser('output',
+                    help='cost of one uinput write, into a stand-in file instead of /dev/uinput')
+    output.add_argument('-n', '--count', type=int, default=100000,
+                    help='number of writes per batch size')
+    output.add_argument('--file', help='file to write the events to (default: /dev/null)')
+    output.set_defaults(func=bench_output)
+    leak = subparsers.add_parser('leak',
+                    help='plug tablets in and out and break the output connection hundreds of '
+                         'times, and check that no fds, threads or objects leak')
+    leak.add_argument('-n', '--cycles', type=int, default=500,
+                    help='number of times to plug a tablet in and out')
+    leak.add_argument('--break-every', type=int, default=7,
+                    help='break the output connection after this many keys')
+    leak.add_argument('--output', choices=('null', 'xdo', 'uinput'), default='null',
+                    help='also open and close this real output backend as many times')
+    leak.set_defaults(func=bench_leak)
+    startup = subparsers.add_parser('startup',
+                    help='loading a large config from scratch (cold) vs from its cache (warm)')
+    startup.add_argument('-n', '--count', type=int, default=200,
+                    help='number of loads of each kind')
+    startup.add_argument('--modes', type=int, default=32,
+                    help='dial modes in the generated config')
+    startup.set_defaults(func=bench_startup)
+    imports = subparsers.add_parser('imports',
+                    help='python -X importtime of huion_keys, and the run time of --rules')
+    imports.add_argument('-n', '--count', type=int, default=10,
+                    help='number of new interpreters to time')
+    imports.add_argument('--top', type=int, default=10,
+                    help='how many of the slowest modules to list')
+    imports.add_argument('--save', help='write the results as JSON to this file')
+    imports.add_argument('--baseline', help='compare against results saved with --save')
+    imports.set_defaults(func=bench_imports)
+    timers = subparsers.add_parser('timers',
+                    help='gesture scheduler: adding, cancelling and firing many pending timers')
+    timers.add_argument('-n', '--count', type=int, default=10000,
+                    help='number of timers, half of them are cancelled')
+    timers.add_argument('--spread', type=float, default=2.0,
+                    help='the timers are due evenly over this many seconds')
+    timers.add_argument('--lead', type=float, default=1.0,
+                    help='seconds before the first timer is due')
+    timers.set_defaults(func=bench_timers)
+    args = parser.parse_args()
+    return args.func(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,11 +1,26 @@
 #!/usr/bin/env python3
 import os
+import io
+import sys
 import time
+import atexit
+import signal
+import mmap
+import errno
+import ctypes
+import hashlib
+import marshal
+import fcntl
+import socket
+import struct
+import queue
+import logging
 import argparse
+import selectors
 import threading
 import configparser
-
-from _xdo_cffi import ffi, lib
+import logging.handlers
+from collections import namedtuple
 
 CONFIG_FILE_PATH = None
 
@@ -14,22 +29,266 @@ TABLET_MODELS = {
     "Q620M": "256c:006d",
 }
 
-BUTTON_BINDINGS = {}
-BUTTON_BINDINGS_HOLD = {}
-CYCLE_BUTTON = None
-CYCLE_MODES = 1
-DIAL_MODES = {}
-
-BUTTON_BITS = {
-    0x01: 1,
-    0x02: 2,
-    0x04: 3,
-    0x08: 4,
-    0x10: 5,
-    0x20: 6,
-    0x40: 7,
-    0x80: 8,
+# Everything is logged through LOG at these levels. Messages about single
+# tablet events are DEBUG, so they are dropped by the default INFO level
+# before any formatting happens.
+DEBUG = logging.DEBUG
+INFO = logging.INFO
+WARNING = logging.WARNING
+ERROR = logging.ERROR
+LOG = logging.getLogger('huion_keys')
+# how many log records may be waiting for the writer thread before new ones
+# are dropped
+LOG_QUEUE_SIZE = 1024
+# DroppingQueueHandler that setup_logging() installed, if any
+LOG_HANDLER = None
+
+# largest ctl request or response
+CONTROL_MESSAGE_SIZE = 1 << 20
+# how many key actions may be waiting for the X server before new taps are dropped
+EMIT_QUEUE_SIZE = 256
+# kinds of actions queued for the Emitter
+TAP = 0
+KEY_DOWN = 1
+KEY_UP = 2
+MOVE = 3  # one step of the scroll strip or dial, coalesced with the ones after it
+TEXT = 4  # a string typed by a macro
+CLICK = 5  # a mouse button clicked by a macro
+CALL = 6  # a function to call from the Emitter thread, once what came before it is sent
+# macro step -> the Emitter action that performs it
+MACRO_ACTIONS = {'key': TAP, 'text': TEXT, 'click': CLICK}
+# how many macros may run at the same time, and wait for their turn
+MACRO_LIMIT = 4
+MACRO_QUEUE_SIZE = 16
+
+# netlink protocol and multicast groups for kernel and udev uevents
+NETLINK_KOBJECT_UEVENT = 15
+UEVENT_KERNEL_GROUP = 1
+UEVENT_UDEV_GROUP = 2
+# inotify event masks from <sys/inotify.h>
+IN_ATTRIB = 0x00000004
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+
+# inotify events for the config file, which editors may replace instead of rewriting
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+# XStringToKeysym() result for unknown names, from X.h
+NO_SYMBOL = 0
+
+# Scroll strip and dial steps that arrive within RELATIVE_WINDOW seconds of
+# each other are sent as one batch. Faster movement sends more keys per step:
+# n steps in a window turn into n * (1 + RELATIVE_ACCELERATION * (n - 1)) keys.
+# These are the defaults for the [Relative] section of the config.
+RELATIVE_WINDOW = 0.02
+RELATIVE_ACCELERATION = 0.25
+# A button with a long press binding sends it once it has been held for
+# LONG_PRESS_TIME seconds. One with a double tap binding waits up to
+# DOUBLE_TAP_TIME seconds after being released for a second press. These are
+# the defaults for the [Gestures] section of the config.
+LONG_PRESS_TIME = 0.5
+DOUBLE_TAP_TIME = 0.25
+# Key bindings from the config file. read_config() builds a new Bindings and
+# nothing modifies it afterwards, so a reload swaps it in with one assignment
+# to BINDINGS and readers see either the old bindings or the new ones, never a
+# mix. Code that looks at several fields should read BINDINGS only once.
+Bindings = namedtuple('Bindings', [
+    'buttons',       # button number or relative event name -> key sequence
+    'hold',          # button number -> key sequence held down with the button
+    'cycle_button',  # button that switches to the next mode, or None
+    'cycle_modes',   # number of modes
+    'dial_modes',    # mode -> binding name -> key sequence
+    'relative_window',
+    'relative_acceleration',
+    'chords',        # mask of the buttons of a chord -> key sequence
+    'chord_buttons', # mask of every button that is part of a chord
+    'long',          # button number -> key sequence for holding it down
+    'double',        # button number -> key sequence for pressing it twice
+    'long_press_time',
+    'double_tap_time',
+    'profiles',      # (name, window class, window name, Bindings) of every
+                     # [Profile] section, in the order of the config file
+])
+BINDINGS = Bindings({}, {}, None, 1, {}, RELATIVE_WINDOW, RELATIVE_ACCELERATION, {}, 0,
+                    {}, {}, LONG_PRESS_TIME, DOUBLE_TAP_TIME, ())
+# With profiles, BINDINGS is the profile of the focused window and FOCUS is
+# the FocusTracker that picks it from these bindings of the whole config file.
+CONFIG_BINDINGS = BINDINGS
+FOCUS = None
+RELOAD_LOCK = threading.Lock()
+# Stats instance collecting latency histograms and counters with --stats
+STATS = None
+# SessionRecorder writing every report to a file with --record
+RECORDER = None
+# compiled config cache, saved next to the config file with this suffix. The
+# version is bumped whenever the layout of the cached data changes.
+CONFIG_CACHE_SUFFIX = '.cache'
+CONFIG_CACHE_VERSION = 4
+# what reading a broken config file raises: bad key names and values, missing
+# sections or options, and syntax errors
+CONFIG_ERRORS = (ValueError, KeyError, configparser.Error)
+# key sequence -> tuple of its keysyms, filled in by read_config()
+KEYSYMS = {}
+# lower case key name aliases -> their keysym names, the same as symbol_map in
+# libxdo's xdo.c
+SYMBOL_MAP = {
+    b'alt': b'Alt_L',
+    b'ctrl': b'Control_L',
+    b'control': b'Control_L',
+    b'meta': b'Meta_L',
+    b'super': b'Super_L',
+    b'shift': b'Shift_L',
 }
+# The _xdo_cffi binding built by xdo_build.py. It is only loaded by
+# load_xdo() when an XdoBackend is created, so that everything else (--rules,
+# checking the config, decoding and replaying) works without libxdo or an X
+# server.
+ffi = None
+lib = None
+# libX11 loaded through ctypes, for looking up key names and following the focus
+XLIB = None
+# the C report pre-filter that xdo_build.py builds next to _xdo_cffi, loaded
+# by load_filter(). filter_lib is False if it hasn't been built.
+filter_ffi = None
+filter_lib = None
+# from X.h and Xatom.h
+PROPERTY_CHANGE_MASK = 1 << 22
+STRUCTURE_NOTIFY_MASK = 1 << 17
+DESTROY_NOTIFY = 17
+PROPERTY_NOTIFY = 28
+ANY_PROPERTY_TYPE = 0
+XA_WINDOW = 33
+XA_WM_NAME = 39
+
+# every hidraw report from the supported tablets is 12 bytes long
+REPORT_SIZE = 12
+# how many reports worth of buffer to hand to each read(). hidraw itself only
+# returns one report per read(), but pipes and recorded sessions fill it up.
+# REPORT_SIZE * READ_BATCH is kept within CPython's small int cache (<= 256)
+# so that buffer offsets never allocate.
+READ_BATCH = 20
+
+# --record log: an 8 byte header followed by fixed-size records of a
+# CLOCK_MONOTONIC timestamp in nanoseconds, the index of the device in the
+# log, two bytes of padding and the raw report
+RECORD_MAGIC = b'HKREC\x00\x01\x00'
+RECORD_HEADER = struct.Struct('<QH2x')
+RECORD_SIZE = RECORD_HEADER.size + REPORT_SIZE
+# device index of the record that starts every --record run appended to a
+# log. Device indexes and timestamps start over after it.
+RECORD_SESSION = 0xffff
+
+# uinput ioctls and event codes from <linux/uinput.h> and <linux/input.h>
+UI_DEV_CREATE = 0x5501
+UI_DEV_DESTROY = 0x5502
+UI_DEV_SETUP = 0x405c5503
+UI_SET_EVBIT = 0x40045564
+UI_SET_KEYBIT = 0x40045565
+UI_SET_RELBIT = 0x40045566
+EV_SYN = 0
+EV_KEY = 1
+EV_REL = 2
+SYN_REPORT = 0
+REL_X = 0
+REL_Y = 1
+REL_WHEEL = 8
+# X mouse button -> Linux button code, or wheel step for 4 (up) and 5 (down)
+UINPUT_BUTTONS = {1: (EV_KEY, 0x110), 2: (EV_KEY, 0x112), 3: (EV_KEY, 0x111),  # BTN_LEFT MIDDLE RIGHT
+                  4: (EV_REL, 1), 5: (EV_REL, -1)}
+BUS_VIRTUAL = 0x06
+# struct input_event: struct timeval, type, code, value. The kernel fills in
+# the time of events written to uinput.
+INPUT_EVENT = struct.Struct('llHHi')
+SYN_EVENT = INPUT_EVENT.pack(0, 0, EV_SYN, SYN_REPORT, 0)
+# struct uinput_setup: struct input_id, name, ff_effects_max
+UINPUT_SETUP = struct.Struct('HHHH80sI')
+
+# keysym -> Linux key codes to press for it on a US layout keyboard
+UINPUT_KEYS = {}
+for keys, shifted, first_code in (
+        ('1234567890-=', '!@#$%^&*()_+', 2),
+        ('qwertyuiop[]', 'QWERTYUIOP{}', 16),
+        ("asdfghjkl;'`", 'ASDFGHJKL:"~', 30),
+        ('\\', '|', 43),
+        ('zxcvbnm,./', 'ZXCVBNM<>?', 44)):
+    for code, (key, shifted_key) in enumerate(zip(keys, shifted), first_code):
+        UINPUT_KEYS[ord(key)] = (code,)
+        UINPUT_KEYS[ord(shifted_key)] = (42, code)  # KEY_LEFTSHIFT
+UINPUT_KEYS[ord(' ')] = (57,)
+for keysym, code in (
+        (0xff08, 14), (0xff09, 15), (0xff0d, 28), (0xff13, 119), (0xff14, 70),  # BackSpace Tab Return Pause Scroll_Lock
+        (0xff1b, 1), (0xff50, 102), (0xff51, 105), (0xff52, 103), (0xff53, 106),  # Escape Home Left Up Right
+        (0xff54, 108), (0xff55, 104), (0xff56, 109), (0xff57, 107), (0xff61, 99),  # Down Prior Next End Print
+        (0xff63, 110), (0xff67, 127), (0xff7f, 69), (0xffff, 111), (0xffe5, 58),  # Insert Menu Num_Lock Delete Caps_Lock
+        (0xffe1, 42), (0xffe2, 54), (0xffe3, 29), (0xffe4, 97), (0xffe7, 125),  # Shift_L/R Control_L/R Meta_L
+        (0xffe8, 126), (0xffe9, 56), (0xffea, 100), (0xffeb, 125), (0xffec, 126),  # Meta_R Alt_L/R Super_L/R
+        (0xff8d, 96), (0xffaa, 55), (0xffab, 78), (0xffad, 74), (0xffae, 83), (0xffaf, 98)):  # keypad
+    UINPUT_KEYS[keysym] = (code,)
+for number, code in enumerate((82, 79, 80, 81, 75, 76, 77, 71, 72, 73)):
+    UINPUT_KEYS[0xffb0 + number] = (code,)  # KP_0 to KP_9
+for number, code in enumerate(list(range(59, 69)) + [87, 88] + list(range(183, 195))):
+    UINPUT_KEYS[0xffbe + number] = (code,)  # F1 to F24
+del keys, shifted, first_code, code, key, shifted_key, keysym, number
+
+# Events yielded by open_tablet(). Buttons are numbered like in the config file,
+# strip direction is 'up' or 'down' and dial direction is 'cw' or 'ccw'.
+ButtonEvent = namedtuple('ButtonEvent', ['button', 'pressed'])
+StripEvent = namedtuple('StripEvent', ['direction'])
+DialEvent = namedtuple('DialEvent', ['direction'])
+
+# Every event and every tuple of events returned by ReportDecoder is built
+# once up front (or cached the first time it is seen), so decoding a report
+# never creates new objects.
+NO_EVENTS = ()
+# BUTTON_EVENTS[button][pressed]
+BUTTON_EVENTS = [None] + [(ButtonEvent(button, False), ButtonEvent(button, True))
+                          for button in range(1, 17)]
+RELATIVE_EVENTS = {
+    'scroll_up': (StripEvent('up'),),
+    'scroll_down': (StripEvent('down'),),
+    'dial_cw': (DialEvent('cw'),),
+    'dial_ccw': (DialEvent('ccw'),),
+}
+# binding names of the strip and dial events
+EVENT_NAMES = {events[0]: name for name, events in RELATIVE_EVENTS.items()}
+
+# report type (byte 1 of each report) -> what kind of report it is. Pen
+# reports and anything else we don't know about are IGNORED_REPORT.
+IGNORED_REPORT = 0
+BUTTON_REPORT = 1
+STRIP_REPORT = 2
+DIAL_REPORT = 3  # dial on Q620M, practically 2 buttons
+REPORT_KINDS = [IGNORED_REPORT] * 256
+REPORT_KINDS[0xe0] = BUTTON_REPORT
+REPORT_KINDS[0xf0] = STRIP_REPORT
+REPORT_KINDS[0xf1] = DIAL_REPORT
+# dial byte 5 -> events
+DIAL_EVENTS = [NO_EVENTS] * 256
+DIAL_EVENTS[0x01] = RELATIVE_EVENTS['dial_cw']
+DIAL_EVENTS[0xff] = RELATIVE_EVENTS['dial_ccw']
+# (changed button mask << 16 | new button mask) -> button events
+BUTTON_TRANSITIONS = {}
+
+
+def button_transitions(changed, mask):
+    """Returns the press or release events for every button bit set in changed."""
+    return tuple(BUTTON_EVENTS[bit + 1][(mask >> bit) & 1]
+                 for bit in range(16) if changed & (1 << bit))
+
+
+# precompile the common case of a single button going down or up
+for bit in range(16):
+    BUTTON_TRANSITIONS[1 << bit << 16 | 1 << bit] = button_transitions(1 << bit, 1 << bit)
+    BUTTON_TRANSITIONS[1 << bit << 16] = button_transitions(1 << bit, 0)
+del bit
+# huion_filter() codes of the strip and dial events, the same as the
+# HUION_FILTER_* constants in xdo_build.py. Button transitions are passed as
+# their BUTTON_TRANSITIONS key, which is never below 1 << 16.
+FILTER_EVENTS = [NO_EVENTS] * 5
+FILTER_EVENTS[1] = RELATIVE_EVENTS['scroll_up']
+FILTER_EVENTS[2] = RELATIVE_EVENTS['scroll_down']
+FILTER_EVENTS[3] = RELATIVE_EVENTS['dial_cw']
+FILTER_EVENTS[4] = RELATIVE_EVENTS['dial_ccw']
 
 
 def main():
@@ -40,10 +299,32 @@ def main():
                     help='print out the udev rules for known tablets and exit')
     parser.add_argument('-c', '--config', type=str,
                     help='location of config file, ~/.config/huion_keys.conf by default')
+    parser.add_argument('--stats', action='store_true', default=False,
+                    help='measure latencies and print them on SIGUSR1 and at exit')
+    parser.add_argument('--record', metavar='FILE',
+                    help='append every report read from the tablets to FILE')
+    parser.add_argument('--replay', metavar='FILE',
+                    help='instead of reading a tablet, replay a session recorded with --record')
+    parser.add_argument('--speed', type=float, default=1.0,
+                    help='replay speed, 10 is ten times faster, 0 is as fast as possible (default: 1)')
+    parser.add_argument('--engine', choices=('threads', 'selector'), default='threads',
+                    help='run one thread per hidraw node, or multiplex all of them from a '
+                         'single selector loop (default: threads)')
+    parser.add_argument('--log-level', choices=('debug', 'info', 'warning', 'error'), default='info',
+                    help='how much to log, debug logs every button press (default: info)')
+    parser.add_argument('--output', choices=sorted(OUTPUT_BACKENDS), default='xdo',
+                    help='send keys to X with libxdo, or through a virtual keyboard created '
+                         'with /dev/uinput (default: xdo)')
+    parser.add_argument('--socket', metavar='PATH',
+                    help='listen for "%(prog)s ctl" commands on this Unix socket '
+                         '(default: $XDG_RUNTIME_DIR/huion_keys.sock)')
+    if sys.argv[1:2] == ['ctl']:
+        return ctl(sys.argv[2:])
     args = parser.parse_args()
     if args.rules:
         make_rules()
         return 0
+    setup_logging(getattr(logging, args.log_level.upper()))
 
     global CONFIG_FILE_PATH
     if args.config is None:
@@ -52,203 +333,2986 @@ def main():
     else:
         CONFIG_FILE_PATH = os.path.expanduser(args.config)
 
+    backend = OUTPUT_BACKENDS[args.output]()
     if os.path.isfile(CONFIG_FILE_PATH):
-        read_config(CONFIG_FILE_PATH)
+        try:
+            bindings = load_bindings(CONFIG_FILE_PATH, backend)
+        except CONFIG_ERRORS as e:
+            log(ERROR, "Invalid config file", path=CONFIG_FILE_PATH, error=e)
+            return 1
+        set_bindings(bindings)
     else:
-        print("No config file found.")
+        log(ERROR, "No config file found")
         create_default_config(CONFIG_FILE_PATH)
-        print("Created an example config file at " + CONFIG_FILE_PATH)
+        log(INFO, "Created an example config file", path=CONFIG_FILE_PATH)
         return 1
 
-    hidraw_paths = []
-    while True:
-        # search for a known tablet devices
-        for device_name, device_id in TABLET_MODELS.items():
-            hidraw_path = get_tablet_hidraw(device_id)
-            if hidraw_path is not None:
-                print("Found %s at %s" % (device_name, hidraw_path))
-                hidraw_paths = hidraw_paths + hidraw_path
-        if not hidraw_paths:
-            print("Could not find any tablet hidraw devices")
-            time.sleep(3)
-            continue
-        elif hidraw_paths:
-            threads = []
-            for hidraw_path in hidraw_paths:
-                thread = PollThread(hidraw_path)
-                # Do not let the threads to continue if main script is terminated
-                thread.daemon = True
-                threads.append(thread)
-                thread.start()
-            # TODO: Maybe should be reworked for the edge case of having more than one tablet connected at the same time.
-            for thread in threads:
-                thread.join()
-            hidraw_paths.clear()
-            continue
+    # one thread owns the output backend and sends the keys for every tablet
+    emitter = Emitter(backend)
+    emitter.daemon = True
+    if args.stats:
+        global STATS
+        STATS = Stats(emitter)
+        STATS.dump_on(signal.SIGUSR1)
+        atexit.register(STATS.dump)
+    if args.record:
+        global RECORDER
+        try:
+            RECORDER = SessionRecorder(args.record)
+        except OSError as e:
+            log(ERROR, "Could not open the recording", path=args.record, error=e)
+            return 1
+        atexit.register(RECORDER.close)
+    if args.replay:
+        # before anything is started, so a bad file is only an error message
+        try:
+            replay = SessionReplay(args.replay, args.speed)
+        except (OSError, ValueError) as e:
+            log(ERROR, "Could not replay the recording", path=args.replay, error=e)
+            return 1
+    # make SIGTERM go through the atexit handlers too
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    emitter.start()
+    # close the output connection on the way out
+    atexit.register(emitter.shutdown)
+    if args.replay:
+        replay.run(emitter)
+        # let everything that was replayed go out
+        emitter.shutdown(None)
+        return 0
+    try:
+        watcher = ConfigWatcher(CONFIG_FILE_PATH, backend)
+    except OSError as e:
+        log(WARNING, "Not watching the config file for changes", path=CONFIG_FILE_PATH, error=e)
+    else:
+        watcher.daemon = True
+        watcher.start()
+    monitor = HotplugMonitor()
+    if args.engine == 'selector':
+        engine = SelectorEngine(emitter, monitor)
+    else:
+        engine = Supervisor(emitter, monitor)
+    if STATS is not None:
+        STATS.engine = engine
+    try:
+        control = ControlServer(args.socket or control_socket_path(), emitter, engine, backend)
+    except OSError as e:
+        log(WARNING, "Not listening for ctl commands", error=e)
+    else:
+        engine.serve(control)
+        atexit.register(control.close)
+    # attaches tablets as they show up, never returns
+    engine.run()
 
-  
-class PollThread(threading.Thread):
+
+class ReportDecoder(object):
+    """Table driven decoder for the reports of one tablet.
+
+    decode() turns a report into a tuple of ButtonEvent, StripEvent and
+    DialEvent. Button reports are diffed against the previous 16-bit button
+    mask, so every button that went down or up gets its own event, even when
+    several are pressed at once.
+    """
+
+    def __init__(self):
+        self.buttons = 0
+        self.scroll_state = None
+
+    def decode(self, sequence, i):
+        """Decodes the report at offset i of sequence into a tuple of events."""
+        # byte 0 is 0xf7 on my Kamvas Pro 22, 0x08 on another model and 0xf9
+        # on the Q620M, so only the report type byte is looked at
+        kind = REPORT_KINDS[sequence[i + 1]]
+        if kind == IGNORED_REPORT:
+            return NO_EVENTS
+        elif kind == BUTTON_REPORT:
+            # buttons 1-8 are the bits of byte 4 and buttons 9-16 the bits of byte 5
+            mask = sequence[i + 4] | sequence[i + 5] << 8
+            changed = mask ^ self.buttons
+            if not changed:
+                return NO_EVENTS
+            self.buttons = mask
+            key = changed << 16 | mask
+            events = BUTTON_TRANSITIONS.get(key)
+            if events is None:
+                events = BUTTON_TRANSITIONS[key] = button_transitions(changed, mask)
+            return events
+        elif kind == STRIP_REPORT:
+            scroll_pos = sequence[i + 5]
+            if scroll_pos == 0:
+                # reset scroll state after lifting finger off scroll strip
+                self.scroll_state = None
+            elif self.scroll_state is None:
+                self.scroll_state = scroll_pos
+            # scroll strip is numbered from top to bottom so a greater new
+            # value means they scrolled down
+            elif scroll_pos > self.scroll_state:
+                self.scroll_state = scroll_pos
+                return RELATIVE_EVENTS['scroll_down']
+            elif scroll_pos < self.scroll_state:
+                self.scroll_state = scroll_pos
+                return RELATIVE_EVENTS['scroll_up']
+            return NO_EVENTS
+        return DIAL_EVENTS[sequence[i + 5]]
+
+    def decode_all(self, sequence, start, end):
+        """Returns the events of every report in sequence[start:end] that had any, one tuple per report.
+
+        The same as calling decode() on each report, but inlined with the
+        state kept in locals, so pen reports and unchanged buttons only cost
+        a table lookup.
+        """
+        # every global the loop needs, as a local
+        kinds = REPORT_KINDS
+        ignored, button, strip = IGNORED_REPORT, BUTTON_REPORT, STRIP_REPORT
+        transitions = BUTTON_TRANSITIONS
+        dial_events = DIAL_EVENTS
+        scroll_up, scroll_down = RELATIVE_EVENTS['scroll_up'], RELATIVE_EVENTS['scroll_down']
+        buttons = self.buttons
+        scroll_state = self.scroll_state
+        decoded = []
+        append = decoded.append
+        for i in range(start, end, REPORT_SIZE):
+            kind = kinds[sequence[i + 1]]
+            if kind == ignored:
+                continue
+            elif kind == button:
+                mask = sequence[i + 4] | sequence[i + 5] << 8
+                changed = mask ^ buttons
+                if not changed:
+                    continue
+                buttons = mask
+                key = changed << 16 | mask
+                events = transitions.get(key)
+                if events is None:
+                    events = transitions[key] = button_transitions(changed, mask)
+                append(events)
+            elif kind == strip:
+                scroll_pos = sequence[i + 5]
+                if scroll_pos == 0:
+                    scroll_state = None
+                elif scroll_state is None:
+                    scroll_state = scroll_pos
+                elif scroll_pos > scroll_state:
+                    scroll_state = scroll_pos
+                    append(scroll_down)
+                elif scroll_pos < scroll_state:
+                    scroll_state = scroll_pos
+                    append(scroll_up)
+            else:
+                events = dial_events[sequence[i + 5]]
+                if events:
+                    append(events)
+        self.buttons = buttons
+        self.scroll_state = scroll_state
+        return decoded
+
+
+class NativeReportDecoder(object):
+    """ReportDecoder on top of the C pre-filter built by xdo_build.py.
+
+    huion_filter() walks a whole read in one call, skipping pen reports and
+    reports that don't change anything, and hands back one code per report
+    that did. Only those are looked at in Python.
+    """
+
+    def __init__(self):
+        self.state = filter_ffi.new('huion_filter_state *')
+        # the buffer of the last call and a cdata pointer into it, the buffer
+        # of a ReportReader never moves so the pointer is made once
+        self.sequence = None
+        self.pointer = None
+        self.codes = None
+
+    def decode_all(self, sequence, start, end):
+        """Returns the events of every report in sequence[start:end] that had any, one tuple per report."""
+        if sequence is not self.sequence:
+            self.pointer = filter_ffi.from_buffer(sequence)
+            self.codes = filter_ffi.new('uint32_t[]', len(sequence) // REPORT_SIZE)
+            self.sequence = sequence
+        count = filter_lib.huion_filter(self.state, self.pointer, start, end, self.codes)
+        decoded = []
+        for code in filter_ffi.unpack(self.codes, count):
+            if code < 5:
+                decoded.append(FILTER_EVENTS[code])
+                continue
+            events = BUTTON_TRANSITIONS.get(code)
+            if events is None:
+                events = BUTTON_TRANSITIONS[code] = button_transitions(code >> 16, code & 0xffff)
+            decoded.append(events)
+        return decoded
+
+
+def make_decoder():
+    """Returns a NativeReportDecoder if the C pre-filter has been built, else a ReportDecoder."""
+    if load_filter():
+        return NativeReportDecoder()
+    return ReportDecoder()
+
+
+class Gesture(object):
+    """A press of a button with long press or double tap bindings that hasn't been told apart yet."""
+
+    __slots__ = ('bindings', 'timer', 'released', 'done')
+
+    def __init__(self, bindings):
+        # the bindings at the time of the first press
+        self.bindings = bindings
+        self.timer = None
+        # waiting for a second press
+        self.released = False
+        # a long press or double tap went out, only the release is left
+        self.done = False
+
+
+class Tablet(object):
+    """Decoding and key binding state for a single tablet hidraw node."""
 
     cycle_mode = None
-    scroll_state = None
     hidraw_path = None
-    xdo = None
+    hidraw = None
+    decoder = None
+    # bit mask of the buttons that are down, bit 0 is button 1
+    pressed = 0
+    # buttons that are part of a chord act when they are released instead of
+    # when they are pressed, unless they turn out to be part of a chord
+    deferred = 0
+    # with --stats, perf_counter_ns() when the last read completed and
+    # (read, decode) timestamps of the event that is being handled
+    read_time = None
+    stamp = None
+    # index of this tablet in the --record log
+    record_device = None
 
     def __init__(self, hidraw_path):
-        super(PollThread, self).__init__()
-        self.xdo = lib.xdo_new(ffi.NULL)
         self.hidraw_path = hidraw_path
         self.cycle_mode = 1
+        self.decoder = make_decoder()
+        # button -> key sequence of the hold binding it is holding down
+        self.held = {}
+        # button -> Gesture that isn't known to be a tap, long press or
+        # double tap yet. The lock is shared with the scheduler thread.
+        self.gestures = {}
+        self.lock = threading.Lock()
+        self.reports_read = 0
+        self.reports_decoded = 0
+        self.events = 0
+        if STATS is not None:
+            STATS.add_tablet(self)
+        if RECORDER is not None:
+            self.record_device = RECORDER.device(hidraw_path)
+
+    def open(self, blocking=True):
+        # unbuffered, so that every readinto() is exactly one read() syscall
+        raw = open(self.hidraw_path, 'rb', buffering=0)
+        os.set_blocking(raw.fileno(), blocking)
+        self.hidraw = ReportReader(raw)
+        return self.hidraw
+
+    def close(self, emitter=None):
+        """Closes the hidraw node, releasing the hold bindings that are down through emitter."""
+        with self.lock:
+            for gesture in self.gestures.values():
+                if gesture.timer is not None:
+                    gesture.timer.cancel()
+            self.gestures.clear()
+        if emitter is not None:
+            # unplugged with a hold button down, don't leave the keys stuck
+            for keysequence in self.held.values():
+                log(DEBUG, "Releasing", keys=keysequence)
+                emitter.key_up(keysequence)
+        self.held.clear()
+        if self.hidraw is not None:
+            self.hidraw.close()
+            self.hidraw = None
+        if STATS is not None:
+            STATS.remove_tablet(self)
+
+    def press(self, btn, emitter, bindings):
+        """Sends the key binding for btn. Hold bindings stay down until release() is called."""
+        log(DEBUG, "Got button", device=self.hidraw_path, button=btn)
+        if btn == bindings.cycle_button and bindings.cycle_button is not None:
+            self.cycle_mode = self.cycle_mode + 1
+            if self.cycle_mode > bindings.cycle_modes:
+                self.cycle_mode = 1
+            log(INFO, "Cycling mode", device=self.hidraw_path, mode=self.cycle_mode)
+        elif self.cycle_mode in bindings.dial_modes and btn in bindings.dial_modes[self.cycle_mode]:
+            log(DEBUG, "Sending", keys=bindings.dial_modes[self.cycle_mode][btn], mode=self.cycle_mode)
+            if btn in RELATIVE_EVENTS:
+                emitter.move(bindings.dial_modes[self.cycle_mode][btn], self.stamp)
+            else:
+                emitter.send(bindings.dial_modes[self.cycle_mode][btn], self.stamp)
+        elif btn in bindings.hold:
+            self.held[btn] = bindings.hold[btn]
+            log(DEBUG, "Pressing", keys=self.held[btn])
+            emitter.key_down(self.held[btn], self.stamp)
+        elif btn in bindings.buttons:
+            log(DEBUG, "Sending", keys=bindings.buttons[btn])
+            if btn in RELATIVE_EVENTS:
+                emitter.move(bindings.buttons[btn], self.stamp)
+            else:
+                emitter.send(bindings.buttons[btn], self.stamp)
+
+    def release(self, btn, emitter):
+        """Lets go of the hold binding of btn, if it is holding one down."""
+        # the key sequence that was pressed, even if the config was reloaded since
+        keysequence = self.held.pop(btn, None)
+        if keysequence is not None:
+            log(DEBUG, "Releasing", keys=keysequence)
+            emitter.key_up(keysequence, self.stamp)
+
+    def button_down(self, btn, emitter, bindings):
+        bit = 1 << (btn - 1)
+        self.pressed |= bit
+        # buttons outside of every chord, like a held modifier, don't keep
+        # the chord buttons from chording
+        chording = self.pressed & bindings.chord_buttons
+        chord = bindings.chords.get(chording)
+        if chord is not None:
+            # the chord takes the place of the bindings of its buttons
+            self.deferred &= ~chording
+            if self.gestures:
+                self.cancel_gestures(chording)
+            log(DEBUG, "Sending chord", keys=chord)
+            emitter.send(chord, self.stamp)
+        elif btn not in bindings.hold and (btn in bindings.long or btn in bindings.double):
+            self.gesture_down(btn, emitter, bindings)
+        elif bit & bindings.chord_buttons and btn not in bindings.hold:
+            self.deferred |= bit
+        else:
+            self.press(btn, emitter, bindings)
+
+    def button_up(self, btn, emitter, bindings):
+        bit = 1 << (btn - 1)
+        self.pressed &= ~bit
+        if self.deferred & bit:
+            # it wasn't part of a chord after all
+            self.deferred &= ~bit
+            self.press(btn, emitter, bindings)
+        if self.gestures:
+            self.gesture_up(btn, emitter)
+        self.release(btn, emitter)
+
+    def gesture_down(self, btn, emitter, bindings):
+        with self.lock:
+            gesture = self.gestures.get(btn)
+            if gesture is not None and gesture.released:
+                # pressed again before the tap went out
+                gesture.timer.cancel()
+                gesture.released = False
+                gesture.done = True
+                log(DEBUG, "Sending double tap", keys=gesture.bindings.double[btn])
+                emitter.send(gesture.bindings.double[btn], self.stamp)
+                return
+            gesture = self.gestures[btn] = Gesture(bindings)
+            if btn in bindings.long:
+                gesture.timer = SCHEDULER.call_later(bindings.long_press_time, self.long_press, btn, gesture, emitter)
+
+    def gesture_up(self, btn, emitter):
+        with self.lock:
+            gesture = self.gestures.get(btn)
+            if gesture is None or gesture.released:
+                return
+            if gesture.done:
+                del self.gestures[btn]
+                return
+            if gesture.timer is not None:
+                gesture.timer.cancel()
+            if btn in gesture.bindings.double:
+                # a tap, unless it is pressed again in time
+                gesture.released = True
+                gesture.timer = SCHEDULER.call_later(gesture.bindings.double_tap_time, self.tap, btn, gesture, emitter)
+            else:
+                del self.gestures[btn]
+                self.press(btn, emitter, gesture.bindings)
+
+    def long_press(self, btn, gesture, emitter):
+        """Called by the scheduler once btn has been held down long enough."""
+        with self.lock:
+            # it may have been released while this timer was going off
+            if self.gestures.get(btn) is not gesture or gesture.released or gesture.done:
+                return
+            gesture.done = True
+            log(DEBUG, "Sending long press", keys=gesture.bindings.long[btn])
+            emitter.send(gesture.bindings.long[btn])
+
+    def tap(self, btn, gesture, emitter):
+        """Called by the scheduler when btn wasn't pressed again in time for a double tap."""
+        with self.lock:
+            if self.gestures.get(btn) is not gesture or not gesture.released:
+                return
+            del self.gestures[btn]
+            self.press(btn, emitter, gesture.bindings)
+
+    def cancel_gestures(self, mask):
+        with self.lock:
+            for btn in list(self.gestures):
+                if mask & (1 << (btn - 1)):
+                    gesture = self.gestures.pop(btn)
+                    if gesture.timer is not None:
+                        gesture.timer.cancel()
+
+    def handle(self, event, emitter):
+        # the config may be reloaded at any time, stick to one version of it
+        bindings = BINDINGS
+        # every button is tracked on its own, holding one down doesn't stop
+        # the others, the scroll strip or the dial from working
+        if event.__class__ is ButtonEvent:
+            if event.pressed:
+                self.button_down(event.button, emitter, bindings)
+            else:
+                self.button_up(event.button, emitter, bindings)
+        else:
+            self.press(EVENT_NAMES[event], emitter, bindings)
+
+    def process(self, emitter):
+        """Does one read() of the hidraw node and acts on every report it returned.
+
+        Blocks for tablets opened with blocking=True.
+        """
+        hidraw = self.hidraw
+        if not hidraw.read_some():
+            return
+        if STATS is not None:
+            self.read_time = time.perf_counter_ns()
+        if self.record_device is not None:
+            RECORDER.write(self.record_device, hidraw)
+        self.reports_read += (hidraw.end - hidraw.offset) // REPORT_SIZE
+        # reports are decoded in place, only the ones with events come back
+        decoded = self.decoder.decode_all(hidraw.buffer, hidraw.offset, hidraw.end)
+        hidraw.offset = hidraw.end
+        for events in decoded:
+            self.reports_decoded += 1
+            self.events += len(events)
+            if STATS is not None:
+                self.stamp = (self.read_time, time.perf_counter_ns())
+            for event in events:
+                self.handle(event, emitter)
+
+
+class PollThread(threading.Thread):
+    """Runs a single tablet on its own thread, blocking on its hidraw node."""
+
+    tablet = None
+    emitter = None
+    # called with the thread once it is about to exit
+    done = None
+
+    def __init__(self, hidraw_path, emitter, tablet=None, done=None):
+        super(PollThread, self).__init__()
+        self.emitter = emitter
+        self.tablet = tablet or Tablet(hidraw_path)
+        self.done = done
+
+    def run(self):
+        tablet = self.tablet
+        try:
+            if tablet.hidraw is None:
+                try:
+                    tablet.open()
+                except OSError as e:
+                    # unplugged before we got to open it
+                    log(WARNING, "Could not open the tablet", error=e)
+                    return
+            while True:
+                try:
+                    tablet.process(self.emitter)
+                except (OSError, EOFError) as e:
+                    log(INFO, "Lost connection with the tablet", device=tablet.hidraw_path)
+                    break
+        finally:
+            tablet.close(self.emitter)
+            if self.done is not None:
+                self.done(self)
+
+
+class Device(object):
+    """Lifecycle and counters of one tablet hidraw node, across reconnects."""
+
+    thread = None
+    # time.monotonic() when it was last attached, None while detached
+    attached_at = None
+    # time.monotonic() when it should be opened again, None if it shouldn't
+    retry_at = None
+
+    def __init__(self, hidraw_path, model):
+        self.hidraw_path = hidraw_path
+        self.model = model
+        self.attaches = 0
+        self.uptime = 0.0
+
+    @property
+    def reconnects(self):
+        return max(self.attaches - 1, 0)
+
+    def total_uptime(self, now=None):
+        if self.attached_at is None:
+            return self.uptime
+        return self.uptime + (now or time.monotonic()) - self.attached_at
+
+
+class Supervisor(object):
+    """Attaches every tablet node on its own PollThread and reattaches it when it comes back.
+
+    Each node has its own lifecycle: losing one never stops or delays the
+    others. Nodes are reopened as soon as a hotplug event says they are back
+    or their permissions changed, and otherwise retried on a timer while they
+    exist but can't be opened.
+    """
+
+    # after a failed open or a lost node that is still there
+    RETRY_DELAY = 1.0
+    # for permissions, in case no event says when udev has fixed them up
+    PERMISSION_RETRY_DELAY = 5.0
+
+    def __init__(self, emitter, monitor):
+        self.emitter = emitter
+        self.monitor = monitor
+        # hidraw path -> Device, for every tablet node seen so far
+        self.devices = {}
+        self.lock = threading.Lock()
+        self.finished = []
+        # PollThreads wake the loop up through this pipe when they exit
+        self.wakeup_read, self.wakeup_write = os.pipe2(os.O_NONBLOCK | os.O_CLOEXEC)
+        self.selector = selectors.DefaultSelector()
+        self.selector.register(monitor.fileno(), selectors.EVENT_READ, monitor)
+        self.selector.register(self.wakeup_read, selectors.EVENT_READ, None)
+        self.control = None
+
+    def attach(self, hidraw_path, model):
+        device = self.devices.get(hidraw_path)
+        if device is None:
+            device = self.devices[hidraw_path] = Device(hidraw_path, model)
+        if device.thread is not None:
+            return
+        device.retry_at = None
+        tablet = Tablet(hidraw_path)
+        try:
+            tablet.open()
+        except PermissionError as e:
+            tablet.close()
+            log(WARNING, "Could not open the tablet, waiting for its permissions to change",
+                device=hidraw_path, error=e)
+            device.retry_at = time.monotonic() + self.PERMISSION_RETRY_DELAY
+            return
+        except OSError as e:
+            tablet.close()
+            log(WARNING, "Could not open the tablet", device=hidraw_path, error=e)
+            if os.path.exists(hidraw_path):
+                device.retry_at = time.monotonic() + self.RETRY_DELAY
+            return
+        device.attaches += 1
+        device.attached_at = time.monotonic()
+        if device.attaches > 1:
+            log(INFO, "Reattached the tablet", device=hidraw_path, reconnects=device.reconnects)
+        device.thread = PollThread(hidraw_path, self.emitter, tablet, self.exited)
+        device.thread.daemon = True
+        device.thread.start()
+
+    def exited(self, thread):
+        """Called on a PollThread that is about to exit."""
+        with self.lock:
+            self.finished.append(thread)
+        os.write(self.wakeup_write, b'\0')
+
+    def reap(self):
+        os.read(self.wakeup_read, 4096)
+        with self.lock:
+            finished, self.finished = self.finished, []
+        now = time.monotonic()
+        for thread in finished:
+            thread.join()
+            device = self.devices[thread.tablet.hidraw_path]
+            device.uptime = device.total_uptime(now)
+            device.attached_at = None
+            device.thread = None
+            # a node that was unplugged is reattached by its add event
+            if os.path.exists(device.hidraw_path):
+                device.retry_at = now + self.RETRY_DELAY
+
+    def hotplug(self):
+        models = {device_id: device_name for device_name, device_id in TABLET_MODELS.items()}
+        for action, hidraw_path, device_id in self.monitor.read():
+            device = self.devices.get(hidraw_path)
+            if action == 'remove':
+                if device is not None:
+                    # its thread finds out on its own, just stop retrying
+                    device.retry_at = None
+                    log(INFO, "Tablet was unplugged", device=hidraw_path)
+            elif device_id in models and (device is None or device.thread is None):
+                if action == 'add':
+                    log(INFO, "Found tablet", model=models[device_id], device=hidraw_path)
+                self.attach(hidraw_path, models[device_id])
+
+    def retry(self):
+        now = time.monotonic()
+        for device in list(self.devices.values()):
+            if device.retry_at is not None and device.retry_at <= now:
+                self.attach(device.hidraw_path, device.model)
+
+    def timeout(self):
+        retries = [device.retry_at for device in self.devices.values() if device.retry_at is not None]
+        if not retries:
+            return None
+        return max(min(retries) - time.monotonic(), 0)
 
     def run(self):
-        global BUTTON_BINDINGS, BUTTON_BINDINGS_HOLD, CYCLE_MODES, CYCLE_BUTTON, DIAL_MODES
+        for device_name, hidraw_path in find_tablets(self.monitor):
+            self.attach(hidraw_path, device_name)
+        if not self.devices:
+            log(INFO, "Could not find any tablet hidraw devices")
         while True:
+            for key, events in self.selector.select(self.timeout()):
+                if key.data is self.monitor:
+                    self.hotplug()
+                elif key.data is self.control:
+                    self.control.ready(key.fileobj)
+                else:
+                    self.reap()
+            self.retry()
+
+    def serve(self, control):
+        """Answers the requests of control from this loop."""
+        self.control = control
+        control.register(self.selector)
+
+    def attached(self):
+        """Returns the Tablets that are attached."""
+        return [device.thread.tablet for device in self.devices.values() if device.thread is not None]
+
+    def dump(self, file=None):
+        file = file or sys.stdout
+        now = time.monotonic()
+        print("%-24s %-10s %12s %10s" % ('device', 'state', 'uptime (s)', 'reconnects'), file=file)
+        for hidraw_path, device in sorted(self.devices.items()):
+            state = 'attached' if device.thread is not None else 'detached'
+            print("%-24s %-10s %12.1f %10d" % (
+                hidraw_path, state, device.total_uptime(now), device.reconnects), file=file)
+
+
+class SelectorEngine(object):
+    """Runs every tablet from the calling thread with a single selector.
+
+    All hidraw nodes are opened non-blocking and multiplexed with selectors
+    (epoll on Linux), so adding devices does not add threads. Given a
+    HotplugMonitor, tablets are attached as soon as they are plugged in.
+    """
+
+    def __init__(self, emitter, monitor=None):
+        self.selector = selectors.DefaultSelector()
+        self.emitter = emitter
+        self.tablets = {}
+        self.monitor = monitor
+        if monitor is not None:
+            self.selector.register(monitor.fileno(), selectors.EVENT_READ, monitor)
+        self.control = None
+
+    def serve(self, control):
+        """Answers the requests of control from this loop."""
+        self.control = control
+        control.register(self.selector)
+
+    def add(self, hidraw_path):
+        if hidraw_path in self.tablets:
+            return self.tablets[hidraw_path]
+        tablet = Tablet(hidraw_path)
+        hidraw = tablet.open(blocking=False)
+        self.selector.register(hidraw.fileno(), selectors.EVENT_READ, tablet)
+        self.tablets[hidraw_path] = tablet
+        return tablet
+
+    def remove(self, tablet):
+        self.selector.unregister(tablet.hidraw.fileno())
+        del self.tablets[tablet.hidraw_path]
+        tablet.close(self.emitter)
+
+    def attach(self, hidraw_path):
+        if hidraw_path in self.tablets:
+            return
+        try:
+            self.add(hidraw_path)
+        except OSError as e:
+            # PermissionError will be retried once udev fixes up the node
+            log(WARNING, "Could not open the tablet", error=e)
+
+    def hotplug(self):
+        models = {device_id: device_name for device_name, device_id in TABLET_MODELS.items()}
+        for action, hidraw_path, device_id in self.monitor.read():
+            if action == 'remove':
+                if hidraw_path in self.tablets:
+                    log(INFO, "Tablet was unplugged", device=hidraw_path)
+                    self.remove(self.tablets[hidraw_path])
+            elif device_id in models and hidraw_path not in self.tablets:
+                log(INFO, "Found tablet", model=models[device_id], device=hidraw_path)
+                self.attach(hidraw_path)
+
+    def run(self):
+        """Dispatches tablet input until every tablet has been disconnected.
+
+        With a monitor, keeps running and waiting for tablets forever.
+        """
+        if self.monitor is not None:
+            for device_name, hidraw_path in find_tablets(self.monitor):
+                self.attach(hidraw_path)
+            if not self.tablets:
+                log(INFO, "Could not find any tablet hidraw devices")
+        while self.tablets or self.monitor is not None:
+            for key, events in self.selector.select():
+                if key.data is self.monitor:
+                    self.hotplug()
+                    continue
+                if key.data is self.control:
+                    self.control.ready(key.fileobj)
+                    continue
+                tablet = key.data
+                if self.tablets.get(tablet.hidraw_path) is not tablet:
+                    # removed by a hotplug event earlier in this batch
+                    continue
+                try:
+                    tablet.process(self.emitter)
+                except (OSError, EOFError) as e:
+                    log(INFO, "Lost connection with the tablet", device=tablet.hidraw_path)
+                    self.remove(tablet)
+
+    def attached(self):
+        """Returns the Tablets that are attached."""
+        return list(self.tablets.values())
+
+    def dump(self, file=None):
+        file = file or sys.stdout
+        print("%-24s %-10s" % ('device', 'state'), file=file)
+        for hidraw_path in sorted(self.tablets):
+            print("%-24s %-10s" % (hidraw_path, 'attached'), file=file)
+
+
+class ControlServer(object):
+    """Answers "huion_keys.py ctl" requests on a Unix domain socket.
+
+    The socket is SOCK_SEQPACKET, so every request and every response is
+    exactly one message and there is no framing to do. A request is a
+    command and its arguments separated by spaces, a response is 'ok' or
+    'error: <reason>' on the first line followed by the output. The
+    listening socket and the clients are registered on the selector of the
+    main loop, which calls ready() for them, so nothing blocks. Only reload
+    is answered from a thread of its own: it reads the config file and may
+    wait for the ConfigWatcher, which would hold up the tablets of the
+    selector engine.
+    """
+
+    COMMANDS = {
+        'mode': "mode [<mode> [<device>]]: shows the dial mode of every tablet, or sets it",
+        'reload': "reload: reads the config file again",
+        'devices': "devices: lists the tablet devices",
+        'stats': "stats: shows the counters, and latencies with --stats",
+        'help': "help: shows this",
+    }
+
+    def __init__(self, path, emitter, engine, backend):
+        self.path = path
+        self.emitter = emitter
+        self.engine = engine
+        self.backend = backend
+        self.selector = None
+        self.clients = set()
+        # taken to send a response or to close a client, which may happen on
+        # different threads
+        self.lock = threading.Lock()
+        self.socket = socket.socket(socket.AF_UNIX, socket.SOCK_SEQPACKET | socket.SOCK_CLOEXEC)
+        try:
+            self.bind()
+        except OSError:
+            self.socket.close()
+            raise
+        self.socket.setblocking(False)
+
+    def bind(self):
+        try:
+            self.socket.bind(self.path)
+        except OSError as e:
+            if e.errno != errno.EADDRINUSE:
+                raise
+            # left behind by an instance that didn't exit cleanly, unless it is still running
+            probe = socket.socket(socket.AF_UNIX, socket.SOCK_SEQPACKET)
             try:
-                hidraw = open(self.hidraw_path, 'rb')
-                break
-            except PermissionError as e:
-                print(e)
-                print("Trying again in 5 seconds...")
-                time.sleep(5)
-                continue
+                probe.connect(self.path)
+            except ConnectionRefusedError:
+                os.unlink(self.path)
+                self.socket.bind(self.path)
+            else:
+                raise OSError(errno.EADDRINUSE, "Another huion_keys.py is listening", self.path)
+            finally:
+                probe.close()
+        os.chmod(self.path, 0o600)
+        self.socket.listen(8)
 
-        while True:
+    def register(self, selector):
+        self.selector = selector
+        selector.register(self.socket, selectors.EVENT_READ, self)
+
+    def close(self):
+        for client in list(self.clients):
+            self.drop(client)
+        self.socket.close()
+        try:
+            os.unlink(self.path)
+        except OSError:
+            pass
+
+    def drop(self, client):
+        with self.lock:
+            self.clients.discard(client)
+            if self.selector is not None:
+                self.selector.unregister(client)
+            client.close()
+
+    def ready(self, sock):
+        if sock is self.socket:
+            try:
+                client, address = self.socket.accept()
+            except BlockingIOError:
+                return
+            client.setblocking(False)
+            self.clients.add(client)
+            self.selector.register(client, selectors.EVENT_READ, self)
+            return
+        try:
+            request = sock.recv(CONTROL_MESSAGE_SIZE)
+        except BlockingIOError:
+            return
+        except OSError:
+            request = b''
+        if not request:
+            self.drop(sock)
+            return
+        words = request.decode('utf-8', 'replace').split()
+        if words[:1] == ['reload']:
+            threading.Thread(target=self.answer, args=(sock, words), name='ControlReload',
+                             daemon=True).start()
+            return
+        self.answer(sock, words)
+
+    def answer(self, sock, words):
+        """Runs a request and sends its response to sock, unless it was dropped meanwhile."""
+        try:
+            response = 'ok\n' + self.handle(words)
+        except ValueError as e:
+            response = 'error: %s\n' % (e,)
+        with self.lock:
+            if sock not in self.clients:
+                return
             try:
-                btn = self.get_button_press(hidraw)
+                sock.send(response.encode('utf-8'))
             except OSError as e:
-                print("%s lost connection with the tablet..." % (self.name,))
-                break
-            print("Got button %s" % (btn,))
-            if btn == CYCLE_BUTTON and CYCLE_BUTTON is not None:
-                self.cycle_mode = self.cycle_mode + 1
-                if self.cycle_mode > CYCLE_MODES:
-                    self.cycle_mode = 1
-                print("Cycling to mode %s" % (self.cycle_mode,))
-            elif self.cycle_mode in DIAL_MODES and btn in DIAL_MODES[self.cycle_mode]:
-                print("Sending %s from Mode %d" % (DIAL_MODES[self.cycle_mode][btn], self.cycle_mode),)
-                lib.xdo_send_keysequence_window(
-                            self.xdo, lib.CURRENTWINDOW, DIAL_MODES[self.cycle_mode][btn], 1000)
-            elif btn in BUTTON_BINDINGS_HOLD:
-                print("Pressing %s" % (BUTTON_BINDINGS_HOLD[btn],))
-                lib.xdo_send_keysequence_window_down(self.xdo, lib.CURRENTWINDOW, BUTTON_BINDINGS_HOLD[btn], 12000)
-                self.get_button_release(hidraw)
-                print("Releasing %s" % (BUTTON_BINDINGS_HOLD[btn],))
-                lib.xdo_send_keysequence_window_up(self.xdo, lib.CURRENTWINDOW, BUTTON_BINDINGS_HOLD[btn], 12000)
-            elif btn in BUTTON_BINDINGS:
-                print("Sending %s" % (BUTTON_BINDINGS[btn],))
-                lib.xdo_send_keysequence_window(
-                    self.xdo, lib.CURRENTWINDOW, BUTTON_BINDINGS[btn], 1000)
-
-    def get_button_press(self, hidraw):
+                # a client that doesn't read its responses, or one too big to
+                # send. The main loop drops it once it sees the shutdown.
+                log(WARNING, "Could not answer a ctl request", error=e)
+                try:
+                    sock.shutdown(socket.SHUT_RDWR)
+                except OSError:
+                    pass
+
+    def handle(self, words):
+        """Runs a request, returns its output. Raises ValueError for bad requests."""
+        if not words or words[0] not in self.COMMANDS:
+            raise ValueError("unknown command, try help")
+        command, args = words[0], words[1:]
+        output = io.StringIO()
+        if command == 'mode':
+            self.mode(args, output)
+        elif command == 'reload':
+            if not reload_bindings(CONFIG_FILE_PATH, self.backend):
+                raise ValueError("the config file has errors, kept the old one")
+        elif command == 'devices':
+            self.engine.dump(output)
+        elif command == 'stats':
+            if STATS is not None:
+                STATS.dump(output)
+            else:
+                print("keys emitted: %d, dropped: %d, output reconnects: %d, macros running: %d" % (
+                    self.emitter.emitted, self.emitter.dropped, max(self.emitter.connections - 1, 0),
+                    len(self.emitter.macros.running)), file=output)
+                self.engine.dump(output)
+        else:
+            for command in sorted(self.COMMANDS):
+                print(self.COMMANDS[command], file=output)
+        return output.getvalue()
+
+    def mode(self, args, output):
+        tablets = sorted(self.engine.attached(), key=lambda tablet: tablet.hidraw_path)
+        if len(args) > 2:
+            raise ValueError("usage: %s" % (self.COMMANDS['mode'],))
+        if args:
+            bindings = BINDINGS
+            if not args[0].isdigit() or not 1 <= int(args[0]) <= bindings.cycle_modes:
+                raise ValueError("there are %d modes" % (bindings.cycle_modes,))
+            if len(args) == 2:
+                tablets = [tablet for tablet in tablets if tablet.hidraw_path == args[1]]
+                if not tablets:
+                    raise ValueError("no tablet %s" % (args[1],))
+            for tablet in tablets:
+                tablet.cycle_mode = int(args[0])
+                log(INFO, "Switched mode", device=tablet.hidraw_path, mode=tablet.cycle_mode)
+        for tablet in tablets:
+            print("%s %d" % (tablet.hidraw_path, tablet.cycle_mode), file=output)
+
+
+def control_socket_path():
+    """Returns where the control socket goes by default."""
+    runtime_dir = os.getenv('XDG_RUNTIME_DIR')
+    if runtime_dir:
+        return os.path.join(runtime_dir, 'huion_keys.sock')
+    return '/tmp/huion_keys-%d.sock' % (os.getuid(),)
+
+
+def ctl(argv):
+    """The "huion_keys.py ctl" client, sends one request to a running huion_keys.py."""
+    parser = argparse.ArgumentParser(prog='huion_keys.py ctl',
+            description='Controls a running huion_keys.py. Commands: ' + ', '.join(sorted(ControlServer.COMMANDS)))
+    parser.add_argument('--socket', metavar='PATH',
+                    help='the socket of huion_keys.py (default: $XDG_RUNTIME_DIR/huion_keys.sock)')
+    parser.add_argument('command')
+    parser.add_argument('args', nargs='*')
+    args = parser.parse_args(argv)
+    path = args.socket or control_socket_path()
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+    try:
+        client.connect(path)
+        client.send(' '.join([args.command] + args.args).encode('utf-8'))
+        response = client.recv(CONTROL_MESSAGE_SIZE).decode('utf-8', 'replace')
+    except OSError as e:
+        print("Could not talk to huion_keys.py at %s: %s" % (path, e), file=sys.stderr)
+        return 1
+    finally:
+        client.close()
+    status, sep, output = response.partition('\n')
+    sys.stdout.write(output)
+    if status != 'ok':
+        print(status, file=sys.stderr)
+        return 1
+    return 0
+
+
+class Timer(object):
+    """A callback waiting in a Scheduler.
+
+    cancel() keeps it from being called, unless the callback has already
+    started running by then. Callbacks that can race their cancel() still
+    have to check for it themselves, like Tablet does with its gestures.
+    """
+
+    __slots__ = ('scheduler', 'tick', 'callback', 'args', 'cancelled')
+
+    def __init__(self, scheduler, tick, callback, args):
+        self.scheduler = scheduler
+        self.tick = tick
+        self.callback = callback
+        self.args = args
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+        self.scheduler.cancel(self)
+
+
+class Scheduler(threading.Thread):
+    """Calls callbacks after a delay, all from one thread, on a hashed timer wheel.
+
+    Timers are put in one of SLOTS buckets by the tick they are due on, so
+    adding and cancelling one are O(1) and each tick only looks at its own
+    bucket, however many timers are pending. Timers further away than SLOTS
+    ticks wait in their bucket for more than one turn of the wheel. The
+    thread only wakes up every tick while there are timers pending.
+
+    Callbacks run on the scheduler thread and must not block, anything slow
+    belongs on the Emitter.
+    """
+
+    # seconds per tick, the resolution of the timers
+    TICK = 0.01
+    SLOTS = 256
+
+    def __init__(self):
+        super(Scheduler, self).__init__(name='Scheduler')
+        self.daemon = True
+        self.condition = threading.Condition()
+        # insertion ordered dicts used as sets, so that cancelling is O(1)
+        self.slots = [{} for _ in range(self.SLOTS)]
+        self.pending = 0
+        self.start_time = time.monotonic()
+        # the next tick to run
+        self.tick = 0
+        self.started = False
+
+    def now(self):
+        """Returns the tick that is due now."""
+        return int((time.monotonic() - self.start_time) / self.TICK)
+
+    def call_later(self, delay, callback, *args):
+        """Calls callback(*args) in delay seconds, rounded up to a tick. Returns its Timer."""
+        with self.condition:
+            if not self.started:
+                self.started = True
+                self.start()
+            now = self.now()
+            if not self.pending:
+                # nothing to catch up on after being idle
+                self.tick = now
+            timer = Timer(self, now + max(int(-(-delay // self.TICK)), 1), callback, args)
+            self.slots[timer.tick % self.SLOTS][timer] = None
+            self.pending += 1
+            self.condition.notify()
+        return timer
+
+    def cancel(self, timer):
+        with self.condition:
+            if self.slots[timer.tick % self.SLOTS].pop(timer, False) is None:
+                self.pending -= 1
+
+    def expire(self):
+        """Waits for the next tick with due timers and takes them out of the wheel."""
+        with self.condition:
+            while True:
+                if not self.pending:
+                    self.condition.wait()
+                    continue
+                delay = self.start_time + self.tick * self.TICK - time.monotonic()
+                if delay > 0:
+                    self.condition.wait(delay)
+                    continue
+                slot = self.slots[self.tick % self.SLOTS]
+                expired = [timer for timer in slot if timer.tick <= self.tick]
+                for timer in expired:
+                    del slot[timer]
+                self.pending -= len(expired)
+                self.tick += 1
+                if expired:
+                    return expired
+
+    def run(self):
         while True:
-            sequence = hidraw.read(12)
-            # 0xf7 is what my Kamvas Pro 22 reads
-            # another model seems to send 0x08
-            # Q620M reads as 0xf9
-            if sequence[0] != 0xf7 and sequence[0] != 0x08 and sequence[0] != 0xf9:
-                pass
-            if sequence[1] == 0xe0:  # buttons
-                # doesn't seem like the tablet will let you push two buttons at once
-                if sequence[4] > 0:
-                    return BUTTON_BITS[sequence[4]]
-                elif sequence[5] > 0:
-                    # right-side buttons are 8-15, so add 8
-                    return BUTTON_BITS[sequence[5]] + 8
-                else:
-                    # must be button release (all zeros)
+            for timer in self.expire():
+                # cancelled after expire() took it out of the wheel
+                if timer.cancelled:
                     continue
-            elif sequence[1] == 0xf0:  # scroll strip
-                scroll_pos = sequence[5]
-                if scroll_pos == 0:
-                    # reset scroll state after lifting finger off scroll strip
-                    self.scroll_state = None
-                elif self.scroll_state is not None:
-                    # scroll strip is numbered from top to bottom so a greater new
-                    # value means they scrolled down
-                    if scroll_pos > self.scroll_state:
-                        self.scroll_state = scroll_pos
-                        return 'scroll_down'
-                    elif scroll_pos < self.scroll_state:
-                        self.scroll_state = scroll_pos
-                        return 'scroll_up'
-                else:
-                    self.scroll_state = scroll_pos
+                try:
+                    timer.callback(*timer.args)
+                except Exception:
+                    LOG.exception("Timer callback failed")
+
+
+# shared by everything that has to happen later, its thread is started by the
+# first call_later()
+SCHEDULER = Scheduler()
+
+
+class Emitter(threading.Thread):
+    """Sends key sequences through an output backend from its own thread.
+
+    Tablets only queue up actions, so reading hidraw never waits for the
+    backend or a slow X server. If the output falls too far behind, new taps
+    are dropped, but key downs and ups are always delivered so nothing gets
+    stuck.
+
+    Scroll strip and dial steps are coalesced: the steps that arrive within
+    the configured window of the first one are accelerated and sent as one batch
+    per key sequence.
+
+    The Emitter owns the only connection of the backend, shared by every
+    tablet. If it breaks (or can't be opened), it is closed and reopened with
+    exponential backoff between RECONNECT_DELAY and RECONNECT_DELAY_MAX.
+    Actions that come in while there is no connection are dropped instead of
+    piling up.
+
+    Macro bindings are handed to a MacroRunner, which feeds their steps back
+    to the Emitter one at a time.
+    """
+
+    RECONNECT_DELAY = 0.1
+    RECONNECT_DELAY_MAX = 5.0
+
+    def __init__(self, backend, maxsize=EMIT_QUEUE_SIZE):
+        super(Emitter, self).__init__(name='Emitter')
+        self.backend = backend
+        self.queue = queue.Queue(maxsize)
+        self.dropped = 0
+        # key sequences sent, counting every key of a batch
+        self.emitted = 0
+        self.connected = False
+        # how many times the backend has been opened
+        self.connections = 0
+        self.retry_at = 0
+        self.retry_delay = self.RECONNECT_DELAY
+        self.macros = MacroRunner(self)
+
+    # Every action can carry the (read, decode) timestamps of the event that
+    # caused it. With --stats, the time it was queued is added to them.
+
+    def send(self, keysequence, stamp=None):
+        if keysequence.__class__ is tuple:
+            # a macro, starts or cancels it
+            self.macros.toggle(keysequence)
+            return
+        self.put_nowait((TAP, keysequence, stamp_queued(stamp)))
+
+    def move(self, keysequence, stamp=None):
+        if keysequence.__class__ is tuple:
+            # a macro, a swipe or turn sends many steps, so they only ever
+            # start it and the steps while it runs are ignored
+            self.macros.start(keysequence)
+            return
+        self.put_nowait((MOVE, keysequence, stamp_queued(stamp)))
+
+    def put_nowait(self, action):
+        """Queues action, returns False if it had to be dropped."""
+        try:
+            self.queue.put_nowait(action)
+        except queue.Full:
+            self.dropped += 1
+            log(WARNING, "Key output is falling behind, dropped keys", keys=action[1])
+            return False
+        return True
+
+    def key_down(self, keysequence, stamp=None):
+        self.queue.put((KEY_DOWN, keysequence, stamp_queued(stamp)))
+
+    def key_up(self, keysequence, stamp=None):
+        self.queue.put((KEY_UP, keysequence, stamp_queued(stamp)))
+
+    def stop(self):
+        """Makes the thread exit once everything queued so far has been sent."""
+        self.queue.put(None)
+
+    def connect(self):
+        """Opens the backend unless it failed too recently, returns whether it is open."""
+        if self.connected:
+            return True
+        now = time.monotonic()
+        if now < self.retry_at:
+            return False
+        try:
+            self.backend.open()
+        except OSError as e:
+            log(WARNING, "Could not open the output", error=e, retry_in=self.retry_delay)
+            self.retry_at = now + self.retry_delay
+            self.retry_delay = min(self.retry_delay * 2, self.RECONNECT_DELAY_MAX)
+            return False
+        if self.connections:
+            log(INFO, "Reconnected the output")
+        self.connected = True
+        self.connections += 1
+        self.retry_delay = self.RECONNECT_DELAY
+        return True
+
+    def disconnect(self):
+        if not self.connected:
+            return
+        self.connected = False
+        try:
+            self.backend.close()
+        except OSError as e:
+            log(WARNING, "Could not close the output cleanly", error=e)
+
+    def shutdown(self, timeout=1.0):
+        """Sends what is queued, closes the backend and waits for the thread to exit."""
+        if self.is_alive():
+            self.stop()
+            self.join(timeout)
+
+    def run(self):
+        self.connect()
+        action = self.queue.get()
+        while action is not None:
+            if action[0] == MOVE and BINDINGS.relative_window > 0:
+                # returns whatever ended the window, or False if it just ran out
+                action = self.coalesce(action)
+                if action is not False:
                     continue
-            elif sequence[1] == 0xf1:  # dial on Q620M, practically 2 buttons
-                if sequence[5] == 0x1:
-                    return 'dial_cw'
-                elif sequence[5] == 0xff:
-                    return 'dial_ccw'
+            elif action[0] == CALL:
+                action[1](*action[2])
+            else:
+                self.perform(action[0], action[1], action[2])
+            action = self.queue.get()
+        self.disconnect()
+
+    def coalesce(self, first):
+        """Collects the steps of one window and sends them, one batch per key sequence.
+
+        Returns the first other action that came in during the window (which
+        ends it early), or False if there wasn't one.
+        """
+        bindings = BINDINGS
+        # key sequence -> steps, in the order they first came in
+        steps = {first[1]: 1}
+        deadline = time.monotonic() + bindings.relative_window
+        action = False
+        while True:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                action = self.queue.get(timeout=timeout)
+            except queue.Empty:
+                action = False
+                break
+            if action is None or action[0] != MOVE:
+                break
+            steps[action[1]] = steps.get(action[1], 0) + 1
+            action = False
+        for keysequence, count in steps.items():
+            # the batch is timed from the first step in the window
+            self.perform(MOVE, keysequence, first[2], accelerate(count, bindings.relative_acceleration))
+        return action
+
+    def perform(self, kind, keysequence, stamp=None, repeat=1):
+        if not self.connect():
+            self.dropped += repeat
+            return
+        try:
+            if kind == KEY_DOWN:
+                self.backend.key_down(keysequence)
+            elif kind == KEY_UP:
+                self.backend.key_up(keysequence)
+            elif kind == TEXT:
+                self.backend.type_text(keysequence)
+            elif kind == CLICK:
+                self.backend.click(keysequence)
             else:
+                self.backend.tap(keysequence, repeat)
+        except OSError as e:
+            log(WARNING, "Lost the output, reconnecting", error=e)
+            self.disconnect()
+            self.dropped += repeat
+            return
+        self.emitted += repeat
+        if stamp is not None and STATS is not None:
+            STATS.record(keysequence, stamp, time.perf_counter_ns())
+
+
+class MacroRun(object):
+    """One run of a macro, which is a (name, steps) tuple."""
+
+    __slots__ = ('macro', 'step', 'timer', 'cancelled')
+
+    def __init__(self, macro):
+        self.macro = macro
+        # index of the next step
+        self.step = 0
+        # the Timer of the wait step it is in, if any
+        self.timer = None
+        self.cancelled = False
+
+
+class MacroRunner(object):
+    """Runs macros a step at a time, without ever blocking the thread that started them.
+
+    A step is queued on the Emitter together with a CALL back to advance(),
+    so the next one only starts once it has been sent. Waits are timers on the
+    SCHEDULER. Up to MACRO_LIMIT macros run at once, further ones wait their
+    turn in a queue of MACRO_QUEUE_SIZE. Toggling a macro that is already
+    running or waiting cancels it instead, starting it does nothing.
+    """
+
+    def __init__(self, emitter):
+        self.emitter = emitter
+        self.lock = threading.Lock()
+        self.running = []
+        self.waiting = []
+
+    def toggle(self, macro):
+        """Starts macro, or cancels it if it is already running or waiting."""
+        self.start(macro, cancel=True)
+
+    def start(self, macro, cancel=False):
+        """Starts macro unless it is already running or waiting."""
+        with self.lock:
+            for run in self.running + self.waiting:
+                if run.macro == macro:
+                    if not cancel:
+                        return
+                    log(INFO, "Cancelled macro", macro=macro[0])
+                    run = self.stop(run)
+                    break
+            else:
+                run = MacroRun(macro)
+                if len(self.running) < MACRO_LIMIT:
+                    log(DEBUG, "Running macro", macro=macro[0])
+                    self.running.append(run)
+                else:
+                    if len(self.waiting) < MACRO_QUEUE_SIZE:
+                        log(DEBUG, "Queued macro", macro=macro[0])
+                        self.waiting.append(run)
+                    else:
+                        log(WARNING, "Too many macros waiting, dropped one", macro=macro[0])
+                        self.emitter.dropped += 1
+                    run = None
+        if run is not None:
+            self.advance(run)
+
+    def stop(self, run):
+        """Takes run out, returns the waiting run that took its place, if any. Needs the lock."""
+        run.cancelled = True
+        if run.timer is not None:
+            run.timer.cancel()
+        if run in self.waiting:
+            self.waiting.remove(run)
+            return None
+        self.running.remove(run)
+        if self.waiting:
+            self.running.append(self.waiting.pop(0))
+            return self.running[-1]
+        return None
+
+    def advance(self, run):
+        """Starts the next step of run. Called from whichever thread finished the last one."""
+        with self.lock:
+            if run.cancelled:
+                return
+            if run.step == len(run.macro[1]):
+                log(DEBUG, "Finished macro", macro=run.macro[0])
+                run = self.stop(run)
+                if run is None:
+                    return
+            kind, value = run.macro[1][run.step]
+            run.step += 1
+            if kind == 'wait':
+                run.timer = SCHEDULER.call_later(value, self.advance, run)
+                return
+        if not (self.emitter.put_nowait((MACRO_ACTIONS[kind], value, None))
+                and self.emitter.put_nowait((CALL, self.advance, (run,)))):
+            log(WARNING, "Key output is falling behind, cancelled macro", macro=run.macro[0])
+            with self.lock:
+                run = None if run.cancelled else self.stop(run)
+            if run is not None:
+                self.advance(run)
+
+
+# Output backends. The Emitter calls check() for every binding at startup,
+# open() and close() from its own thread, and tap(), key_down() and key_up()
+# for every action. check() raises ValueError for key sequences the backend
+# can't send. open() and the actions raise OSError when the output is gone,
+# after which the Emitter closes the backend and opens it again later. Macros
+# use type_text() and click() as well, checked with check_text() and
+# check_click().
+
+def keysyms_of(keysequence):
+    """Returns the keysyms of keysequence, parsing it the first time."""
+    keysyms = KEYSYMS.get(keysequence)
+    if keysyms is None:
+        keysyms = KEYSYMS[keysequence] = parse_keysequence(keysequence)
+    return keysyms
+
+
+class XdoBackend(object):
+    """Sends keys to the X server with libxdo (XTEST).
+
+    Key sequences are resolved into charcodemap_t arrays the first time they
+    are sent and handed straight to libxdo afterwards, instead of letting
+    libxdo parse the string and look up keycodes on every press. The cache is
+    thrown away when the X keyboard mapping changes.
+
+    Xlib normally exits the whole program when it loses the connection to
+    the X server. Instead, the connection is marked dead and the next call
+    raises OSError, so that the Emitter can reconnect.
+    """
+
+    xdo = None
+    # set by on_io_error() when Xlib finds the connection broken
+    dead = False
+
+    def __init__(self):
+        load_xdo()
+        # key sequence -> (charcodemap_t array, number of keys)
+        self.charcodes = {}
+        self.event = ffi.new('XEvent *')
+        # called by Xlib instead of exit() once the connection is broken.
+        # XSetIOErrorExitHandler() is new in libX11 1.7, so it is looked up
+        # through ctypes instead of being part of _xdo_cffi
+        self.on_io_error = X_IO_ERROR_EXIT_HANDLER(lambda display, data: setattr(self, 'dead', True))
+
+    def check(self, keysequence):
+        keysyms_of(keysequence)
+
+    def check_text(self, text):
+        # libxdo binds whatever keysyms the text needs
+        pass
+
+    def check_click(self, button):
+        if button < 1:
+            raise ValueError("no mouse button %d" % (button,))
+
+    def open(self):
+        xdo = lib.xdo_new(ffi.NULL)
+        if xdo == ffi.NULL:
+            raise OSError("Could not open X display %s" % (os.environ.get('DISPLAY'),))
+        self.xdo = xdo
+        self.dead = False
+        xlib = load_xlib()
+        if hasattr(xlib, 'XSetIOErrorExitHandler'):
+            display = int(ffi.cast('uintptr_t', xdo.xdpy))
+            xlib.XSetIOErrorExitHandler(display, self.on_io_error, None)
+
+    def close(self):
+        if self.xdo is not None:
+            # also closes the display
+            lib.xdo_free(self.xdo)
+            self.xdo = None
+        # keycodes belong to the connection they were looked up on
+        self.charcodes.clear()
+
+    def check_result(self, result):
+        """Raises OSError if a libxdo call failed or the connection died while it ran."""
+        if self.dead:
+            raise OSError("Lost the connection to the X server")
+        if result != lib.XDO_SUCCESS:
+            raise OSError("libxdo could not send the keys")
+
+    def resolve(self, keysequence):
+        """Builds the charcodemap_t array for keysequence the way libxdo would."""
+        keysyms = keysyms_of(keysequence)
+        keys = ffi.new('charcodemap_t[]', len(keysyms))
+        for key, keysym in zip(keys, keysyms):
+            key.symbol = keysym
+            key.code = lib.XKeysymToKeycode(self.xdo.xdpy, keysym)
+            # libxdo temporarily binds keysyms that aren't on the keyboard
+            key.needs_binding = 1 if key.code == 0 else 0
+        self.charcodes[keysequence] = (keys, len(keysyms))
+        return self.charcodes[keysequence]
+
+    def check_keyboard_mapping(self):
+        """Drops the resolved key sequences if the keyboard mapping changed."""
+        while lib.XPending(self.xdo.xdpy):
+            lib.XNextEvent(self.xdo.xdpy, self.event)
+            if self.event.type == lib.MappingNotify:
+                lib.XRefreshKeyboardMapping(ffi.addressof(self.event, 'xmapping'))
+                self.charcodes.clear()
+        self.check_result(lib.XDO_SUCCESS)
+
+    def keys(self, keysequence):
+        self.check_keyboard_mapping()
+        return self.charcodes.get(keysequence) or self.resolve(keysequence)
+
+    def tap(self, keysequence, repeat=1):
+        keys, nkeys = self.keys(keysequence)
+        # like xdo_send_keysequence_window, half the delay goes to each half,
+        # but there is no reason to wait between the keys of a batch
+        for i in range(repeat):
+            delay = 500 if i == repeat - 1 else 0
+            self.check_result(lib.xdo_send_keysequence_window_list_do(
+                self.xdo, lib.CURRENTWINDOW, keys, nkeys, 1, ffi.NULL, delay))
+            self.check_result(lib.xdo_send_keysequence_window_list_do(
+                self.xdo, lib.CURRENTWINDOW, keys, nkeys, 0, ffi.NULL, delay))
+
+    def key_down(self, keysequence):
+        keys, nkeys = self.keys(keysequence)
+        self.check_result(lib.xdo_send_keysequence_window_list_do(
+            self.xdo, lib.CURRENTWINDOW, keys, nkeys, 1, ffi.NULL, 12000))
+
+    def key_up(self, keysequence):
+        keys, nkeys = self.keys(keysequence)
+        self.check_result(lib.xdo_send_keysequence_window_list_do(
+            self.xdo, lib.CURRENTWINDOW, keys, nkeys, 0, ffi.NULL, 12000))
+
+    def type_text(self, text):
+        # the same delay between characters as xdotool type
+        self.check_result(lib.xdo_enter_text_window(
+            self.xdo, lib.CURRENTWINDOW, text.encode('utf-8'), 12000))
+
+    def click(self, button):
+        self.check_result(lib.xdo_click_window(self.xdo, lib.CURRENTWINDOW, button))
+
+
+class UinputBackend(object):
+    """Sends keys through a virtual keyboard created with /dev/uinput.
+
+    Every action is a single write() of ready-made input_event structs: all
+    the key downs of a chord, a SYN_REPORT, the key ups in reverse order and
+    another SYN_REPORT, repeated for batches. There are no X round-trips and
+    no delays, so sending a key costs about one syscall.
+
+    Keysyms are turned into Linux key codes as if the keyboard had a US
+    layout (see UINPUT_KEYS), and so is the text typed by macros. For their
+    clicks, the device is a mouse too. `file` may be any open binary file instead of
+    the uinput node, in which case the events are just written to it.
+    """
+
+    def __init__(self, path='/dev/uinput', file=None):
+        self.path = path
+        self.file = file
+        # a stand-in file belongs to the caller and is never closed
+        self.stand_in = file is not None
+        self.created = False
+        # key sequence -> (down events, up events)
+        self.events = {}
+        # macro text -> events
+        self.texts = {}
+
+    def check(self, keysequence):
+        self.resolve(keysequence)
+
+    def check_text(self, text):
+        self.resolve_text(text)
+
+    def check_click(self, button):
+        if button not in UINPUT_BUTTONS:
+            raise ValueError("no uinput button for mouse button %d" % (button,))
+
+    def resolve(self, keysequence):
+        """Packs the input events that press and release keysequence."""
+        codes = []
+        for keysym in keysyms_of(keysequence):
+            key = UINPUT_KEYS.get(keysym)
+            if key is None:
+                raise ValueError("no uinput key code for keysym 0x%x in '%s'" % (
+                    keysym, keysequence.decode('utf-8')))
+            for code in key:
+                if code not in codes:
+                    codes.append(code)
+        self.events[keysequence] = pack_keys(codes)
+        return self.events[keysequence]
+
+    def resolve_text(self, text):
+        """Packs the input events that type text."""
+        events = []
+        for char in text:
+            # Latin-1 keysyms are the same as the code points
+            keysym = {'\n': 0xff0d, '\t': 0xff09}.get(char, ord(char))
+            if keysym not in UINPUT_KEYS:
+                raise ValueError("no uinput key code for '%s' in '%s'" % (char, text))
+            events.extend(pack_keys(UINPUT_KEYS[keysym]))
+        self.texts[text] = b''.join(events)
+        return self.texts[text]
+
+    def open(self):
+        if self.stand_in:
+            # no device to set up
+            return
+        self.file = open(self.path, 'wb', buffering=0)
+        fd = self.file.fileno()
+        try:
+            fcntl.ioctl(fd, UI_SET_EVBIT, EV_KEY)
+            for code in sorted(set(code for key in UINPUT_KEYS.values() for code in key)):
+                fcntl.ioctl(fd, UI_SET_KEYBIT, code)
+            # a mouse needs motion to be recognized as one, even if it never moves
+            fcntl.ioctl(fd, UI_SET_EVBIT, EV_REL)
+            for code in (REL_X, REL_Y, REL_WHEEL):
+                fcntl.ioctl(fd, UI_SET_RELBIT, code)
+            for kind, code in UINPUT_BUTTONS.values():
+                if kind == EV_KEY:
+                    fcntl.ioctl(fd, UI_SET_KEYBIT, code)
+            fcntl.ioctl(fd, UI_DEV_SETUP, UINPUT_SETUP.pack(
+                BUS_VIRTUAL, 0x256c, 0, 1, b'huion_keys virtual keyboard', 0))
+            fcntl.ioctl(fd, UI_DEV_CREATE)
+        except OSError:
+            self.file.close()
+            self.file = None
+            raise
+        self.created = True
+        # give udev and the display server a moment to pick up the new device,
+        # or the first keys are lost
+        time.sleep(0.2)
+
+    def close(self):
+        if self.file is None or self.stand_in:
+            return
+        try:
+            if self.created:
+                fcntl.ioctl(self.file.fileno(), UI_DEV_DESTROY)
+        finally:
+            self.created = False
+            self.file.close()
+            self.file = None
+
+    def tap(self, keysequence, repeat=1):
+        down, up = self.events.get(keysequence) or self.resolve(keysequence)
+        os.write(self.file.fileno(), (down + up) * repeat)
+
+    def key_down(self, keysequence):
+        down, up = self.events.get(keysequence) or self.resolve(keysequence)
+        os.write(self.file.fileno(), down)
+
+    def key_up(self, keysequence):
+        down, up = self.events.get(keysequence) or self.resolve(keysequence)
+        os.write(self.file.fileno(), up)
+
+    def type_text(self, text):
+        os.write(self.file.fileno(), self.texts.get(text) or self.resolve_text(text))
+
+    def click(self, button):
+        kind, code = UINPUT_BUTTONS[button]
+        if kind == EV_REL:
+            events = INPUT_EVENT.pack(0, 0, EV_REL, REL_WHEEL, code) + SYN_EVENT
+        else:
+            events = b''.join(pack_keys([code]))
+        os.write(self.file.fileno(), events)
+
+
+def pack_keys(codes):
+    """Returns the input events that press the key codes in order, and that release them."""
+    down = b''.join(INPUT_EVENT.pack(0, 0, EV_KEY, code, 1) for code in codes) + SYN_EVENT
+    up = b''.join(INPUT_EVENT.pack(0, 0, EV_KEY, code, 0) for code in reversed(codes)) + SYN_EVENT
+    return down, up
+
+
+OUTPUT_BACKENDS = {
+    'xdo': XdoBackend,
+    'uinput': UinputBackend,
+}
+
+
+def stamp_queued(stamp):
+    """Adds the current time to the (read, decode) timestamps of an event."""
+    if stamp is None or STATS is None:
+        return None
+    return stamp + (time.perf_counter_ns(),)
+
+
+def accelerate(steps, acceleration=RELATIVE_ACCELERATION):
+    """Returns how many keys to send for the given number of steps in one window."""
+    return int(steps * (1 + acceleration * (steps - 1)) + 0.5)
+
+
+class SessionRecorder(object):
+    """Appends every report read from the tablets to a binary log for --replay.
+
+    Each read() is copied into fixed-size records in one preallocated buffer
+    and handed to a buffered file in a single write, without any formatting.
+    """
+
+    def __init__(self, path):
+        self.lock = threading.Lock()
+        self.file = open(path, 'ab')
+        if self.file.tell() == 0:
+            self.file.write(RECORD_MAGIC)
+        self.file.write(RECORD_HEADER.pack(time.monotonic_ns(), RECORD_SESSION) + bytes(REPORT_SIZE))
+        self.devices = {}
+        self.records = bytearray(RECORD_SIZE * READ_BATCH)
+        self.view = memoryview(self.records)
+
+    def device(self, hidraw_path):
+        """Returns the index that the reports of hidraw_path are recorded under."""
+        with self.lock:
+            return self.devices.setdefault(hidraw_path, len(self.devices))
+
+    def write(self, device, hidraw):
+        """Records the complete reports [offset, end) of a ReportReader."""
+        with self.lock:
+            timestamp = time.monotonic_ns()
+            size = 0
+            for i in range(hidraw.offset, hidraw.end, REPORT_SIZE):
+                RECORD_HEADER.pack_into(self.records, size, timestamp, device)
+                self.view[size + RECORD_HEADER.size:size + RECORD_SIZE] = hidraw.view[i:i + REPORT_SIZE]
+                size += RECORD_SIZE
+            self.file.write(self.view[:size])
+
+    def close(self):
+        with self.lock:
+            self.file.close()
+
+
+class ReplayReader(object):
+    """Stands in for ReportReader when SessionReplay loads the reports itself."""
+
+    def __init__(self, name, batch=READ_BATCH):
+        self.name = name
+        self.buffer = bytearray(REPORT_SIZE * batch)
+        self.view = memoryview(self.buffer)
+        self.offset = 0
+        self.end = 0
+
+    def read_some(self):
+        return self.end > self.offset
+
+    def close(self):
+        self.view.release()
+
+
+class SessionReplay(object):
+    """Plays a --record log back through Tablet.process() and the Emitter.
+
+    The log is memory-mapped and its reports are copied into the reader buffer
+    of one Tablet per recorded device, at their recorded pace divided by speed
+    (or as fast as possible for speed 0). Every run of --record in the log
+    gets new Tablets, and is played right after the one before it.
+    """
+
+    def __init__(self, path, speed=1.0):
+        self.path = path
+        self.speed = speed
+        with open(path, 'rb') as log:
+            self.map = mmap.mmap(log.fileno(), 0, access=mmap.ACCESS_READ)
+        if self.map[:len(RECORD_MAGIC)] != RECORD_MAGIC:
+            self.map.close()
+            raise ValueError("%s is not a huion_keys recording" % (path,))
+        self.view = memoryview(self.map)
+        self.tablets = {}
+        # runs of --record seen so far
+        self.sessions = 0
+
+    def tablet(self, device):
+        tablet = self.tablets.get(device)
+        if tablet is None:
+            tablet = self.tablets[device] = Tablet('%s#%d.%d' % (self.path, self.sessions, device))
+            tablet.hidraw = ReplayReader(tablet.hidraw_path)
+        return tablet
+
+    def close_tablets(self, emitter):
+        for tablet in self.tablets.values():
+            tablet.close(emitter)
+        self.tablets.clear()
+
+    def run(self, emitter):
+        start = len(RECORD_MAGIC)
+        end = start + (len(self.map) - start) // RECORD_SIZE * RECORD_SIZE
+        first_timestamp = None
+        position = start
+        while position < end:
+            timestamp, device = RECORD_HEADER.unpack_from(self.map, position)
+            if device == RECORD_SESSION:
+                # another run of --record: its own devices, and its own clock,
+                # which may even have gone backwards after a reboot
+                if self.tablets:
+                    self.close_tablets(emitter)
+                    self.sessions += 1
+                first_timestamp = None
+                position += RECORD_SIZE
+                continue
+            if first_timestamp is None:
+                first_timestamp = timestamp
+                started = time.monotonic()
+            if self.speed > 0:
+                delay = started + (timestamp - first_timestamp) / 1e9 / self.speed - time.monotonic()
+                if delay > 0:
+                    time.sleep(delay)
+            # hand over every report of this device that was read at the same time
+            tablet = self.tablet(device)
+            reader = tablet.hidraw
+            size = 0
+            while position < end and size < len(reader.buffer):
+                next_timestamp, next_device = RECORD_HEADER.unpack_from(self.map, position)
+                if next_timestamp != timestamp or next_device != device:
+                    break
+                report = position + RECORD_HEADER.size
+                reader.view[size:size + REPORT_SIZE] = self.view[report:report + REPORT_SIZE]
+                size += REPORT_SIZE
+                position += RECORD_SIZE
+            reader.offset = 0
+            reader.end = size
+            tablet.process(emitter)
+        self.close_tablets(emitter)
+        self.view.release()
+        self.map.close()
+
+
+class Histogram(object):
+    """Log-linear latency histogram in the style of HdrHistogram.
+
+    Values are counted in buckets of SUB_BUCKETS linear steps per power of two,
+    so percentiles are accurate to within about 1/SUB_BUCKETS of the value,
+    recording is O(1) and the memory used is fixed.
+    """
+
+    SUB_BUCKET_BITS = 5
+    SUB_BUCKETS = 1 << SUB_BUCKET_BITS
+
+    def __init__(self):
+        # enough buckets for any 64-bit value
+        self.counts = [0] * (self.SUB_BUCKETS * (65 - self.SUB_BUCKET_BITS))
+        self.count = 0
+        self.max = 0
+
+    def record(self, value):
+        if value < 0:
+            value = 0
+        shift = value.bit_length() - self.SUB_BUCKET_BITS - 1
+        if shift < 0:
+            index = value
+        else:
+            # the top SUB_BUCKET_BITS + 1 bits of value pick the bucket
+            index = self.SUB_BUCKETS * (shift + 1) + (value >> shift) - self.SUB_BUCKETS
+        self.counts[index] += 1
+        self.count += 1
+        if value > self.max:
+            self.max = value
+
+    def bucket_value(self, index):
+        """Returns the highest value that falls into the bucket at index."""
+        if index < self.SUB_BUCKETS:
+            return index
+        shift = index // self.SUB_BUCKETS - 1
+        mantissa = index % self.SUB_BUCKETS + self.SUB_BUCKETS
+        return (mantissa << shift) + (1 << shift) - 1
+
+    def percentile(self, percent):
+        if not self.count:
+            return 0
+        target = max(int(self.count * percent / 100.0 + 0.5), 1)
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if seen >= target:
+                return min(self.bucket_value(index), self.max)
+        return self.max
+
+
+class Stats(object):
+    """Counters and latency histograms for --stats.
+
+    Latencies are measured from the hidraw read() that returned a report to
+    its decoding, to the action being queued for the Emitter, and to libxdo
+    returning. Each binding gets its own histogram of the whole read to inject
+    latency.
+    """
+
+    PERCENTILES = (50, 90, 99, 99.9)
+
+    def __init__(self, emitter):
+        self.emitter = emitter
+        self.lock = threading.Lock()
+        self.tablets = set()
+        # counters of tablets that were closed already
+        self.reports_read = 0
+        self.reports_decoded = 0
+        self.events = 0
+        self.stages = [('read -> decode', Histogram()),
+                       ('decode -> queue', Histogram()),
+                       ('queue -> inject', Histogram())]
+        self.bindings = {}
+        # set by main() to also report the per-device counters
+        self.engine = None
+
+    def add_tablet(self, tablet):
+        with self.lock:
+            self.tablets.add(tablet)
+
+    def remove_tablet(self, tablet):
+        with self.lock:
+            if tablet in self.tablets:
+                self.tablets.discard(tablet)
+                self.reports_read += tablet.reports_read
+                self.reports_decoded += tablet.reports_decoded
+                self.events += tablet.events
+
+    def record(self, keysequence, stamp, injected):
+        """Records the latencies of one action. Only called from the Emitter thread."""
+        read, decoded, queued = stamp
+        self.stages[0][1].record(decoded - read)
+        self.stages[1][1].record(queued - decoded)
+        self.stages[2][1].record(injected - queued)
+        histogram = self.bindings.get(keysequence)
+        if histogram is None:
+            histogram = self.bindings[keysequence] = Histogram()
+        histogram.record(injected - read)
+
+    def dump_on(self, signum):
+        """Dumps whenever signum arrives.
+
+        The signal handler runs on the main thread, possibly while it holds
+        self.lock or a lock of the engine, so it only wakes up a thread that
+        does the dumping.
+        """
+        requested = threading.Event()
+
+        def dumper():
+            while True:
+                requested.wait()
+                requested.clear()
+                self.dump()
+
+        threading.Thread(target=dumper, name='StatsDump', daemon=True).start()
+        signal.signal(signum, lambda signum, frame: requested.set())
+
+    def dump(self, file=None):
+        file = file or sys.stdout
+        with self.lock:
+            reports_read = self.reports_read + sum(t.reports_read for t in self.tablets)
+            reports_decoded = self.reports_decoded + sum(t.reports_decoded for t in self.tablets)
+            events = self.events + sum(t.events for t in self.tablets)
+        print("reports read: %d, discarded: %d, events: %d, keys emitted: %d, dropped: %d, "
+              "output reconnects: %d" % (
+            reports_read, reports_read - reports_decoded, events,
+            self.emitter.emitted, self.emitter.dropped, max(self.emitter.connections - 1, 0)), file=file)
+        print("%-32s %8s %s %9s (microseconds)" % (
+            'latency', 'count', ' '.join('%9s' % ('p%s' % (p,)) for p in self.PERCENTILES), 'max'),
+            file=file)
+        rows = list(self.stages)
+        rows.extend(("read -> inject '%s'" % (keysequence.decode('utf-8'),), histogram)
+                    for keysequence, histogram in sorted(self.bindings.items()))
+        for name, histogram in rows:
+            print("%-32s %8d %s %9.1f" % (
+                name, histogram.count,
+                ' '.join('%9.1f' % (histogram.percentile(p) / 1000.0,) for p in self.PERCENTILES),
+                histogram.max / 1000.0), file=file)
+        if self.engine is not None:
+            self.engine.dump(file)
+        file.flush()
+
+
+class ReportReader(object):
+    """Reads fixed-size reports from an unbuffered file into one preallocated buffer.
+
+    Reports are never copied out of the buffer. Callers walk the complete
+    reports in [self.offset, self.end) and index into self.buffer directly,
+    calling fill() once they have consumed all of them.
+    """
+
+    def __init__(self, raw, batch=READ_BATCH):
+        self.raw = raw
+        self.buffer = bytearray(REPORT_SIZE * batch)
+        self.view = memoryview(self.buffer)
+        # [offset, end) is the range of complete reports not handed out yet
+        self.offset = 0
+        self.end = 0
+        # bytes of a trailing partial report, kept at self.end
+        self.partial = 0
+
+    def fileno(self):
+        return self.raw.fileno()
+
+    def close(self):
+        self.view.release()
+        self.raw.close()
+
+    def fill(self):
+        """Blocks until at least one complete report is in the buffer."""
+        while not self.read_some():
+            pass
+
+    def read_some(self):
+        """Does a single read() and returns whether it completed any reports."""
+        partial = self.partial
+        # move a partial report left over from a short read to the front
+        if partial and self.end:
+            self.buffer[:partial] = self.view[self.end:self.end + partial]
+        count = self.raw.readinto(self.view[partial:])
+        if count is None:
+            # non-blocking file with nothing to read yet
+            count = 0
+        elif not count:
+            raise EOFError("%s: end of report stream" % (self.raw.name,))
+        filled = partial + count
+        self.offset = 0
+        self.end = filled - filled % REPORT_SIZE
+        self.partial = filled - self.end
+        return self.end > 0
+
+
+async def open_tablet(hidraw_path):
+    """Asynchronously iterates over the events of the tablet at hidraw_path.
+
+    The hidraw node is opened non-blocking and registered with the running
+    event loop, so no thread is needed per device:
+
+        async for event in open_tablet('/dev/hidraw3'):
+            print(event)
+
+    Yields ButtonEvent, StripEvent and DialEvent tuples. Raises OSError or
+    EOFError once the tablet is disconnected.
+    """
+    import asyncio
+    loop = asyncio.get_running_loop()
+    tablet = Tablet(hidraw_path)
+    hidraw = tablet.open(blocking=False)
+    decode_all = tablet.decoder.decode_all
+    readable = asyncio.Event()
+    loop.add_reader(hidraw.fileno(), readable.set)
+    try:
+        while True:
+            await readable.wait()
+            readable.clear()
+            if not hidraw.read_some():
+                continue
+            decoded = decode_all(hidraw.buffer, hidraw.offset, hidraw.end)
+            hidraw.offset = hidraw.end
+            for events in decoded:
+                for event in events:
+                    yield event
+    finally:
+        loop.remove_reader(hidraw.fileno())
+        tablet.close()
+
+
+class HotplugMonitor(object):
+    """Keeps an index of hidraw nodes up to date from hotplug events.
+
+    Subscribes to uevents over netlink (the udev group if udevd is running, so
+    that events arrive after udev has set permissions, otherwise the kernel
+    group). If netlink is not available, watches /dev with inotify instead.
+    """
+
+    def __init__(self):
+        # hidraw path -> device ID, for hidraw nodes that carry input
+        self.nodes = {}
+        # device ID -> set of hidraw paths
+        self.index = {}
+        self.netlink = None
+        self.inotify = None
+        try:
+            self.netlink = socket.socket(socket.AF_NETLINK, socket.SOCK_DGRAM, NETLINK_KOBJECT_UEVENT)
+            group = UEVENT_UDEV_GROUP if os.path.exists('/run/udev/control') else UEVENT_KERNEL_GROUP
+            self.netlink.bind((0, group))
+            self.netlink.setblocking(False)
+        except OSError as e:
+            log(WARNING, "Could not listen for uevents, watching /dev instead", error=e)
+            if self.netlink is not None:
+                self.netlink.close()
+                self.netlink = None
+            self.inotify = Inotify('/dev', IN_CREATE | IN_DELETE | IN_ATTRIB)
+        # subscribe first, then scan, so nothing plugged in between is missed
+        self.rescan()
+
+    def fileno(self):
+        if self.netlink is not None:
+            return self.netlink.fileno()
+        return self.inotify.fileno()
+
+    def close(self):
+        if self.netlink is not None:
+            self.netlink.close()
+        if self.inotify is not None:
+            self.inotify.close()
+
+    def find(self, device_id):
+        """Returns the sorted hidraw paths of the given device ID (in xxxx:xxxx format), or None."""
+        # a node can be gone a moment before its remove event is read
+        paths = sorted(hidraw_path for hidraw_path in self.index.get(device_id.lower(), ())
+                       if os.path.exists(hidraw_path))
+        if paths:
+            return paths
+        return None
+
+    def rescan(self):
+        for hidraw_path in list(self.nodes):
+            self.forget(hidraw_path)
+        for hidraw_path, device_id in scan_hidraw().items():
+            self.remember(hidraw_path, device_id)
+
+    def remember(self, hidraw_path, device_id):
+        self.nodes[hidraw_path] = device_id
+        self.index.setdefault(device_id, set()).add(hidraw_path)
+
+    def forget(self, hidraw_path):
+        device_id = self.nodes.pop(hidraw_path, None)
+        if device_id is not None:
+            self.index[device_id].discard(hidraw_path)
+            if not self.index[device_id]:
+                del self.index[device_id]
+        return device_id
+
+    def wait(self, timeout=None):
+        """Blocks until there are hotplug events, then returns them like read()."""
+        selector = selectors.DefaultSelector()
+        selector.register(self.fileno(), selectors.EVENT_READ)
+        try:
+            selector.select(timeout)
+        finally:
+            selector.close()
+        return self.read()
+
+    def read(self):
+        """Applies pending hotplug events to the index without blocking.
+
+        Returns a list of (action, hidraw path, device ID) tuples, where action
+        is 'add', 'change' (permissions were changed) or 'remove'.
+        """
+        if self.netlink is not None:
+            names = self.read_netlink()
+        else:
+            names = self.inotify.read()
+        changes = []
+        for action, name in names:
+            if not name.startswith('hidraw'):
                 continue
+            hidraw_path = os.path.join('/dev', name)
+            if action == 'remove':
+                device_id = self.forget(hidraw_path)
+                if device_id is not None:
+                    changes.append((action, hidraw_path, device_id))
+                continue
+            device_id = self.nodes.get(hidraw_path)
+            if device_id is None:
+                device_id = hidraw_device_id(name)
+                if device_id is None:
+                    continue
+                self.remember(hidraw_path, device_id)
+                action = 'add'
+            changes.append((action, hidraw_path, device_id))
+        return changes
+
+    def read_netlink(self):
+        names = []
+        while True:
+            try:
+                message = self.netlink.recv(16384)
+            except BlockingIOError:
+                return names
+            except OSError as e:
+                if e.errno != errno.ENOBUFS:
+                    raise
+                # events were dropped, so the index can't be trusted any more
+                log(WARNING, "Missed some hotplug events, rescanning")
+                self.rescan()
+                names.extend(('add', name) for name in os.listdir('/sys/class/hidraw'))
+                continue
+            uevent = parse_uevent(message)
+            if uevent.get('SUBSYSTEM') == 'hidraw' and 'DEVNAME' in uevent:
+                action = 'remove' if uevent.get('ACTION') == 'remove' else 'add'
+                names.append((action, os.path.basename(uevent['DEVNAME'])))
+
+
+class Inotify(object):
+    """Minimal non-blocking inotify watch on a single directory, through libc."""
+
+    def __init__(self, path, mask):
+        self.libc = ctypes.CDLL(None, use_errno=True)
+        self.fd = self.libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        if self.libc.inotify_add_watch(self.fd, os.fsencode(path), mask) < 0:
+            error = ctypes.get_errno()
+            os.close(self.fd)
+            raise OSError(error, "inotify_add_watch failed", path)
+
+    def fileno(self):
+        return self.fd
 
-    def get_button_release(self, hidraw):
+    def close(self):
+        os.close(self.fd)
+
+    def read(self):
+        """Returns a list of (action, file name) for the pending events."""
+        names = []
         while True:
-            sequence = hidraw.read(12)
-            if sequence[1] == 0xe0 and sequence[4] == 0 and sequence[5] == 0:
-                return True
+            try:
+                data = os.read(self.fd, 16384)
+            except BlockingIOError:
+                return names
+            offset = 0
+            # struct inotify_event { int wd; uint32_t mask, cookie, len; char name[]; }
+            while offset < len(data):
+                wd, mask, cookie, length = struct.unpack_from('iIII', data, offset)
+                offset += 16
+                name = data[offset:offset + length].rstrip(b'\0').decode()
+                offset += length
+                if mask & IN_DELETE:
+                    names.append(('remove', name))
+                elif mask & IN_CREATE:
+                    names.append(('add', name))
+                else:
+                    names.append(('change', name))
+
+
+def parse_uevent(message):
+    """Parses a kernel or udev netlink uevent message into a dict of its properties."""
+    if message.startswith(b'libudev\0'):
+        # struct udev_monitor_netlink_header, the properties follow the header
+        magic, header_size, properties_off, properties_len = struct.unpack_from('=4I', message, 8)
+        fields = message[properties_off:properties_off + properties_len].split(b'\0')
+    else:
+        # "ACTION@DEVPATH" followed by the properties
+        fields = message.split(b'\0')[1:]
+    uevent = {}
+    for field in fields:
+        key, sep, value = field.partition(b'=')
+        if sep:
+            uevent[key.decode()] = value.decode(errors='replace')
+    return uevent
+
+
+def hidraw_device_id(name):
+    """Returns the device ID (in xxxx:xxxx format) of /sys/class/hidraw/<name>.
+
+    Returns None if it does not exist or does not carry any input.
+    """
+    try:
+        # e.g. ../../../0003:256C:006E.0001
+        device_path = os.readlink(os.path.join('/sys/class/hidraw', name, 'device'))
+    except OSError:
+        return None
+    # need to confirm that there's "input" because there are two or more hidraw
+    # files listed for the tablet, but only few of them carry the
+    # mouse/keyboard input
+    if not os.path.exists(os.path.join('/sys/class/hidraw', name, 'device/input')):
+        return None
+    parts = os.path.basename(device_path).split('.')[0].split(':')
+    if len(parts) != 3:
+        return None
+    return ('%s:%s' % (parts[1], parts[2])).lower()
+
+
+def scan_hidraw():
+    """Returns {hidraw path: device ID} for every hidraw node that carries input."""
+    nodes = {}
+    for name in os.listdir('/sys/class/hidraw'):
+        device_id = hidraw_device_id(name)
+        if device_id is not None:
+            nodes[os.path.join('/dev', name)] = device_id
+    return nodes
+
+
+def find_tablets(monitor):
+    """Returns (device name, hidraw path) for every known tablet node in the index."""
+    tablets = []
+    # search for a known tablet devices
+    for device_name, device_id in TABLET_MODELS.items():
+        hidraw_path = monitor.find(device_id)
+        if hidraw_path is not None:
+            log(INFO, "Found tablet", model=device_name, devices=' '.join(hidraw_path))
+            tablets.extend((device_name, path) for path in hidraw_path)
+    return tablets
 
 
 def get_tablet_hidraw(device_id):
     """Finds the /dev/hidrawX file or files that belong to the given device ID (in xxxx:xxxx format)."""
-    # TODO: is this too fragile?
-    hidraws = os.listdir('/sys/class/hidraw')
-    inputs = []
-    for h in hidraws:
-        device_path = os.readlink(os.path.join('/sys/class/hidraw', h, 'device'))
-        if device_id.upper() in device_path:
-            # need to confirm that there's "input" because there are two or more hidraw
-            # files listed for the tablet, but only few of them carry the
-            # mouse/keyboard input
-            if os.path.exists(os.path.join('/sys/class/hidraw', h, 'device/input')):
-                inputs.append(os.path.join('/dev', os.path.basename(h)))
+    inputs = sorted(hidraw_path for hidraw_path, node_id in scan_hidraw().items()
+                    if node_id == device_id.lower())
     if inputs:
         return inputs
     return None
 
 
-def read_config(config_file):
-    global CYCLE_MODES, CYCLE_BUTTON, BUTTON_BINDINGS, BUTTON_BINDINGS_HOLD
+def load_xdo():
+    """Loads the _xdo_cffi binding the first time it is needed."""
+    global ffi, lib
+    if lib is None:
+        from _xdo_cffi import ffi, lib
+    return lib
+
+
+def load_filter():
+    """Loads the _huion_filter report pre-filter the first time it is needed.
+
+    Returns False if it hasn't been built, reports are then decoded in Python.
+    """
+    global filter_ffi, filter_lib
+    if filter_lib is None:
+        try:
+            from _huion_filter import ffi as filter_ffi, lib as filter_lib
+        except ImportError:
+            filter_lib = False
+        log(DEBUG, "Decoding reports", native=bool(filter_lib))
+    return filter_lib
+
+
+def load_xlib():
+    """Loads libX11 through ctypes the first time it is needed."""
+    global XLIB
+    if XLIB is None:
+        try:
+            xlib = ctypes.CDLL('libX11.so.6')
+        except OSError:
+            # ctypes.util is slow to import and search with, only use it if needed
+            from ctypes.util import find_library
+            xlib = ctypes.CDLL(find_library('X11'))
+        display, window, atom = ctypes.c_void_p, ctypes.c_ulong, ctypes.c_ulong
+        for name, restype, argtypes in [
+                ('XStringToKeysym', ctypes.c_ulong, [ctypes.c_char_p]),
+                ('XOpenDisplay', display, [ctypes.c_char_p]),
+                ('XCloseDisplay', ctypes.c_int, [display]),
+                ('XConnectionNumber', ctypes.c_int, [display]),
+                ('XDefaultRootWindow', window, [display]),
+                ('XInternAtom', atom, [display, ctypes.c_char_p, ctypes.c_int]),
+                ('XSelectInput', ctypes.c_int, [display, window, ctypes.c_long]),
+                ('XPending', ctypes.c_int, [display]),
+                ('XNextEvent', ctypes.c_int, [display, ctypes.POINTER(XEvent)]),
+                ('XGetWindowProperty', ctypes.c_int, [
+                    display, window, atom, ctypes.c_long, ctypes.c_long, ctypes.c_int, atom,
+                    ctypes.POINTER(atom), ctypes.POINTER(ctypes.c_int), ctypes.POINTER(ctypes.c_ulong),
+                    ctypes.POINTER(ctypes.c_ulong), ctypes.POINTER(ctypes.c_void_p)]),
+                ('XGetClassHint', ctypes.c_int, [display, window, ctypes.POINTER(XClassHint)]),
+                ('XFree', ctypes.c_int, [ctypes.c_void_p]),
+                ('XSetErrorHandler', ctypes.c_void_p, [X_ERROR_HANDLER]),
+                ('XSetIOErrorExitHandler', None, [display, X_IO_ERROR_EXIT_HANDLER, ctypes.c_void_p])]:
+            # XSetIOErrorExitHandler() is new in libX11 1.7
+            function = getattr(xlib, name, None)
+            if function is None:
+                continue
+            function.restype = restype
+            function.argtypes = argtypes
+        XLIB = xlib
+    return XLIB
+
+
+def string_to_keysym(name):
+    """Looks up a keysym name with XStringToKeysym, which doesn't need an X server."""
+    return load_xlib().XStringToKeysym(name)
+
+
+class XEvent(ctypes.Union):
+    """XEvent, with the fields of XPropertyEvent. XDestroyWindowEvent has its window in the same place."""
+
+    class XPropertyEvent(ctypes.Structure):
+        _fields_ = [('type', ctypes.c_int),
+                    ('serial', ctypes.c_ulong),
+                    ('send_event', ctypes.c_int),
+                    ('display', ctypes.c_void_p),
+                    ('window', ctypes.c_ulong),
+                    ('atom', ctypes.c_ulong),
+                    ('time', ctypes.c_ulong),
+                    ('state', ctypes.c_int)]
+
+    _fields_ = [('type', ctypes.c_int),
+                ('xproperty', XPropertyEvent),
+                ('pad', ctypes.c_long * 24)]
+
+
+class XClassHint(ctypes.Structure):
+    _fields_ = [('res_name', ctypes.c_void_p),
+                ('res_class', ctypes.c_void_p)]
+
+
+X_ERROR_HANDLER = ctypes.CFUNCTYPE(ctypes.c_int, ctypes.c_void_p, ctypes.c_void_p)
+X_IO_ERROR_EXIT_HANDLER = ctypes.CFUNCTYPE(None, ctypes.c_void_p, ctypes.c_void_p)
+X_IGNORE_ERRORS = X_ERROR_HANDLER(lambda display, event: 0)
+
+
+def parse_keysequence(keysequence):
+    """Returns the keysyms of a key sequence like b'ctrl+shift+equal'.
+
+    Raises ValueError for key names that X doesn't know about.
+    """
+    keysyms = []
+    for name in keysequence.split(b'+'):
+        name = SYMBOL_MAP.get(name.lower(), name)
+        keysym = string_to_keysym(name)
+        if keysym == NO_SYMBOL:
+            if len(name) != 1:
+                raise ValueError("unknown key '%s' in '%s'" % (name.decode('utf-8'), keysequence.decode('utf-8')))
+            # libxdo falls back to the character itself
+            keysym = name[0]
+        keysyms.append(keysym)
+    return tuple(keysyms)
+
+
+def encode_binding(value):
+    """Encodes a config value into a key sequence and checks that all of its keys exist."""
+    keysequence = value.encode('utf-8')
+    if keysequence not in KEYSYMS:
+        KEYSYMS[keysequence] = parse_keysequence(keysequence)
+    return keysequence
+
+
+def encode_value(value, macros):
+    """Like encode_binding(), but returns the macro from macros for 'macro:<name>'."""
+    if value.startswith('macro:'):
+        name = value[len('macro:'):].strip()
+        if name not in macros:
+            raise ValueError("unknown macro '%s'" % (name,))
+        return macros[name]
+    return encode_binding(value)
+
+
+def all_bindings(bindings):
+    """Yields the key sequence of every binding in bindings, and of every key step of their macros."""
+    for keysequences in ([bindings.buttons, bindings.hold, bindings.chords, bindings.long, bindings.double]
+                         + list(bindings.dial_modes.values())):
+        for keysequence in keysequences.values():
+            if keysequence.__class__ is tuple:
+                for kind, value in keysequence[1]:
+                    if kind == 'key':
+                        yield value
+            else:
+                yield keysequence
+    for name, window_class, window_name, profile in bindings.profiles:
+        for keysequence in all_bindings(profile):
+            yield keysequence
+
+
+def all_macros(bindings):
+    """Yields every macro bound in bindings, as (name, steps)."""
+    for values in ([bindings.buttons, bindings.chords, bindings.long, bindings.double]
+                   + list(bindings.dial_modes.values())):
+        for value in values.values():
+            if value.__class__ is tuple:
+                yield value
+    for name, window_class, window_name, profile in bindings.profiles:
+        for macro in all_macros(profile):
+            yield macro
+
+
+def read_macros(section):
+    """Parses the [Macros] section into {name: (name, steps)}.
+
+    Every line of a macro is a step: 'key <key sequence>', 'text <text>',
+    'click <mouse button>' or 'wait <milliseconds>'. Raises ValueError for
+    anything else.
+    """
+    macros = {}
+    for name in section:
+        steps = []
+        for line in section[name].splitlines():
+            kind, sep, value = line.strip().partition(' ')
+            value = value.strip()
+            if not kind:
+                continue
+            elif kind == 'key':
+                steps.append((kind, encode_binding(value)))
+            elif kind == 'text':
+                steps.append((kind, value))
+            elif kind == 'click':
+                steps.append((kind, int(value)))
+            elif kind == 'wait':
+                steps.append((kind, float(value) / 1000))
+            else:
+                raise ValueError("unknown step '%s' in macro '%s'" % (line.strip(), name))
+        if not steps:
+            raise ValueError("macro '%s' has no steps" % (name,))
+        macros[name] = (name, tuple(steps))
+    return macros
+
+
+def read_config(config_file, contents=None):
+    """Loads the key bindings from config_file and returns them as a Bindings.
+
+    contents is the text of config_file if it was read already. Raises
+    ValueError if a binding uses a key that doesn't exist.
+    """
     CONFIG = configparser.ConfigParser()
-    CONFIG.read(config_file)
+    if contents is None:
+        CONFIG.read(config_file)
+    else:
+        CONFIG.read_string(contents, config_file)
+    macros = read_macros(CONFIG['Macros']) if 'Macros' in CONFIG else {}
+    bindings = read_sections(CONFIG, macros=macros)
+    profiles = []
+    for section in CONFIG:
+        if not section.startswith('Profile '):
+            continue
+        name = section[len('Profile '):].strip()
+        window_class = CONFIG[section].get('class', '').lower() or None
+        window_name = CONFIG[section].get('name', '').lower() or None
+        if window_class is None and window_name is None:
+            log(WARNING, "Profile needs a class or a name to match windows", profile=name)
+            continue
+        profile = read_sections(CONFIG, name + ': ', bindings, macros)
+        profiles.append((name, window_class, window_name, profile))
+    return bindings._replace(profiles=tuple(profiles))
+
+
+def read_sections(CONFIG, prefix='', defaults=None, macros=None):
+    """Reads the bindings of the sections whose names start with prefix.
+
+    For a profile, prefix is its name followed by ': ' and defaults are the
+    bindings of the rest of the config, which the profile's sections add to
+    or override. Bindings like 'macro:<name>' are looked up in macros.
+    """
+    macros = macros or {}
+
+    if defaults is None:
+        defaults = Bindings({}, {}, None, 1, {}, RELATIVE_WINDOW, RELATIVE_ACCELERATION, {}, 0,
+                        {}, {}, LONG_PRESS_TIME, DOUBLE_TAP_TIME, ())
+    buttons = dict(defaults.buttons)
+    hold = dict(defaults.hold)
+    cycle_button = defaults.cycle_button
+    cycle_modes = defaults.cycle_modes
+    dial_modes = defaults.dial_modes
+    relative_window = defaults.relative_window
+    relative_acceleration = defaults.relative_acceleration
+    chords = dict(defaults.chords)
+    long = dict(defaults.long)
+    double = dict(defaults.double)
+    long_press_time = defaults.long_press_time
+    double_tap_time = defaults.double_tap_time
+    # the config has to have [Bindings], profiles don't
+    if prefix == '' or prefix + 'Bindings' in CONFIG:
+        section = CONFIG[prefix + 'Bindings']
+    else:
+        section = {}
     # It is still better for performance to pre-encode these values
-    for binding in CONFIG['Bindings']:
+    for binding in section:
         if binding.isdigit():
             # store button configs with their 1-indexed ID
-            BUTTON_BINDINGS[int(binding)] = CONFIG['Bindings'][binding].encode('utf-8')
+            buttons[int(binding)] = encode_value(section[binding], macros)
+            hold.pop(int(binding), None)
+        elif binding.endswith('.long') and binding[:-len('.long')].isdigit():
+            long[int(binding[:-len('.long')])] = encode_value(section[binding], macros)
+        elif binding.endswith('.double') and binding[:-len('.double')].isdigit():
+            double[int(binding[:-len('.double')])] = encode_value(section[binding], macros)
         elif binding == 'scroll_up':
-            BUTTON_BINDINGS['scroll_up'] = CONFIG['Bindings'][binding].encode('utf-8')
+            buttons['scroll_up'] = encode_value(section[binding], macros)
         elif binding == 'scroll_down':
-            BUTTON_BINDINGS['scroll_down'] = CONFIG['Bindings'][binding].encode('utf-8')
+            buttons['scroll_down'] = encode_value(section[binding], macros)
         elif binding == 'dial_cw':
-            BUTTON_BINDINGS['dial_cw'] = CONFIG['Bindings'][binding].encode('utf-8')
+            buttons['dial_cw'] = encode_value(section[binding], macros)
         elif binding == 'dial_ccw':
-            BUTTON_BINDINGS['dial_ccw'] = CONFIG['Bindings'][binding].encode('utf-8')
+            buttons['dial_ccw'] = encode_value(section[binding], macros)
+        elif all(button.strip().isdigit() for button in binding.split('+')):
+            # a chord like 1+2, stored by the bit mask of its buttons
+            mask = 0
+            for button in binding.split('+'):
+                mask |= 1 << (int(button) - 1)
+            if bin(mask).count('1') < 2:
+                log(WARNING, "Chord needs at least two buttons", binding=binding)
+                continue
+            chords[mask] = encode_value(section[binding], macros)
         elif binding == '':
             continue  # ignore empty line
         else:
-            print("[WARN] unrecognized regular binding '%s'" % (binding,))
+            log(WARNING, "Unrecognized regular binding", binding=binding)
     # Same, but for buttons that should be held down
-    if 'Hold' in CONFIG:
-        for binding in CONFIG['Hold']:
+    if prefix + 'Hold' in CONFIG:
+        for binding in CONFIG[prefix + 'Hold']:
             if binding.isdigit():
-                BUTTON_BINDINGS_HOLD[int(binding)] = CONFIG['Hold'][binding].encode('utf-8')
+                hold[int(binding)] = encode_binding(CONFIG[prefix + 'Hold'][binding])
+                buttons.pop(int(binding), None)
             elif binding == '':
                 continue
             else:
-                print("[WARN] unrecognized hold binding '%s'" % (binding,))
+                log(WARNING, "Unrecognized hold binding", binding=binding)
+    if prefix + 'Relative' in CONFIG:
+        # the window is configured in milliseconds
+        relative_window = CONFIG[prefix + 'Relative'].getfloat('window', relative_window * 1000) / 1000
+        relative_acceleration = CONFIG[prefix + 'Relative'].getfloat('acceleration', relative_acceleration)
+    if prefix + 'Gestures' in CONFIG:
+        # both are configured in milliseconds
+        long_press_time = CONFIG[prefix + 'Gestures'].getfloat('long', long_press_time * 1000) / 1000
+        double_tap_time = CONFIG[prefix + 'Gestures'].getfloat('double', double_tap_time * 1000) / 1000
     # Assume that if cycle is assigned we have modes for now
-    if 'Dial' in CONFIG:
-        CYCLE_BUTTON = int(CONFIG['Dial']['cycle'])
+    if prefix + 'Dial' in CONFIG:
+        cycle_button = int(CONFIG[prefix + 'Dial']['cycle'])
+        # a profile with a dial has its own modes
+        cycle_modes = 1
+        dial_modes = {}
         for key in CONFIG:
-            if key.startswith("Mode"):
+            # the whole name has to match, a profile can be called Modeling
+            name = key[len(prefix):]
+            if key.startswith(prefix) and name.startswith("Mode ") and name[len("Mode "):].isdigit():
                 # Count the modes
-                mode = int(key.split(' ')[1])
-                if mode > CYCLE_MODES:
-                    CYCLE_MODES = mode
-                DIAL_MODES[mode] = {}
+                mode = int(name[len("Mode "):])
+                if mode > cycle_modes:
+                    cycle_modes = mode
+                dial_modes[mode] = {}
                 for binding in CONFIG[key]:
-                    DIAL_MODES[mode][binding] = CONFIG[key][binding].encode('utf-8')
+                    dial_modes[mode][binding] = encode_value(CONFIG[key][binding], macros)
+    chord_buttons = 0
+    for mask in chords:
+        chord_buttons |= mask
+    return Bindings(buttons, hold, cycle_button, cycle_modes, dial_modes,
+                    relative_window, relative_acceleration, chords, chord_buttons,
+                    long, double, long_press_time, double_tap_time, ())
+
+
+def select_profile(bindings, window):
+    """Returns (profile name, Bindings) for window, a (class, instance, name) tuple.
+
+    The first profile whose class is the window's class or instance, or whose
+    name is part of the window's name, wins. Without one, or without a window,
+    returns (None, bindings). All of them are compared in lower case.
+    """
+    if window is not None:
+        window_class, window_instance, window_name = window
+        for name, profile_class, profile_name, profile in bindings.profiles:
+            if profile_class is not None and profile_class in (window_class, window_instance):
+                return name, profile
+            if profile_name is not None and profile_name in window_name:
+                return name, profile
+    return None, bindings
+
+
+def set_bindings(bindings):
+    """Makes bindings the config in use.
+
+    With profiles, the FocusTracker picks the one of the focused window from
+    them, and is started the first time there are any.
+    """
+    global BINDINGS, CONFIG_BINDINGS, FOCUS
+    if bindings.profiles and FOCUS is None:
+        FOCUS = FocusTracker()
+        FOCUS.daemon = True
+        FOCUS.start()
+    if FOCUS is not None:
+        FOCUS.apply(bindings)
+    else:
+        CONFIG_BINDINGS = BINDINGS = bindings
+
+
+def read_config_file(config_file):
+    """Returns the contents of config_file and its modification time, read once."""
+    with open(config_file, 'rb') as config:
+        mtime = os.fstat(config.fileno()).st_mtime_ns
+        return config.read(), mtime
+
+
+def config_cache_key(config_file, contents, mtime):
+    """Returns what a cache of config_file has to match to be used.
+
+    That is the absolute path, the modification time and the SHA-256 of the
+    contents of the config file, and the versions of the cache and marshal
+    formats. contents and mtime come from read_config_file(), and are also
+    what gets parsed, so a file that changes meanwhile can't end up cached
+    under the wrong key.
+    """
+    digest = hashlib.sha256(contents).digest()
+    return (CONFIG_CACHE_VERSION, marshal.version, os.path.abspath(config_file), mtime, digest)
+
+
+def read_config_cache(config_file, key):
+    """Returns the Bindings cached for config_file under key, or None if there is no valid cache.
+
+    Also fills in KEYSYMS for them, so a cached config doesn't need to be
+    parsed or resolved again.
+    """
+    try:
+        with open(config_file + CONFIG_CACHE_SUFFIX, 'rb') as cache:
+            cached_key, bindings, keysyms = marshal.loads(cache.read())
+        if cached_key != key:
+            return None
+        bindings, profiles = bindings[:-1], bindings[-1]
+        bindings = Bindings(*bindings, tuple(profile[:3] + (Bindings(*profile[3]),) for profile in profiles))
+    except (OSError, EOFError, ValueError, TypeError):
+        # missing, unreadable, truncated or from another version
+        return None
+    KEYSYMS.update(keysyms)
+    return bindings
+
+
+def write_config_cache(config_file, key, bindings):
+    """Saves bindings, and the keysyms of their key sequences, as the cache of config_file under key."""
+    keysyms = {keysequence: KEYSYMS[keysequence]
+               for keysequence in all_bindings(bindings) if keysequence in KEYSYMS}
+    cache_file = config_file + CONFIG_CACHE_SUFFIX
+    try:
+        # marshal only takes plain tuples, not the Bindings of the profiles
+        profiles = tuple(profile[:3] + (tuple(profile[3]),) for profile in bindings.profiles)
+        data = marshal.dumps((key, tuple(bindings._replace(profiles=profiles)), keysyms))
+        # write a new file and rename it over the old one, so a crash or a
+        # second instance never leaves a half-written cache behind
+        with open(cache_file + '.%d' % (os.getpid(),), 'wb') as cache:
+            cache.write(data)
+        os.replace(cache_file + '.%d' % (os.getpid(),), cache_file)
+    except OSError as e:
+        log(WARNING, "Could not write config cache", path=cache_file, error=e)
+
+
+def load_bindings(config_file, backend):
+    """Reads config_file, or its cache, and checks that backend can send all of its bindings.
+
+    Raises ValueError if it can't.
+    """
+    contents, mtime = read_config_file(config_file)
+    key = config_cache_key(config_file, contents, mtime)
+    bindings = read_config_cache(config_file, key)
+    if bindings is None:
+        bindings = read_config(config_file, contents.decode('utf-8'))
+        write_config_cache(config_file, key, bindings)
+    for keysequence in all_bindings(bindings):
+        backend.check(keysequence)
+    for name, steps in all_macros(bindings):
+        for kind, value in steps:
+            if kind == 'text':
+                backend.check_text(value)
+            elif kind == 'click':
+                backend.check_click(value)
+    return bindings
+
+
+def reload_bindings(config_file, backend):
+    """Loads config_file and makes it the config in use, unless it has errors.
+
+    Returns whether it did.
+    """
+    # the ConfigWatcher and ctl may both reload, one at a time
+    with RELOAD_LOCK:
+        try:
+            bindings = load_bindings(config_file, backend)
+        except CONFIG_ERRORS as e:
+            log(ERROR, "Not reloading invalid config file", path=config_file, error=e)
+            return False
+        set_bindings(bindings)
+    log(INFO, "Reloaded the config file", path=config_file)
+    return True
+
+
+class ConfigWatcher(threading.Thread):
+    """Reloads the config file whenever it changes.
+
+    The new bindings are read and checked on this thread and then swapped in
+    all at once, so the tablets keep going with the old ones in the meantime.
+    A config with errors is reported and ignored.
+    """
+
+    # how long to wait for an editor to finish writing before reloading
+    SETTLE_TIME = 0.1
+
+    def __init__(self, config_file, backend):
+        super(ConfigWatcher, self).__init__(name='ConfigWatcher')
+        self.config_file = config_file
+        self.backend = backend
+        # editors often write a new file and rename it over the old one, so
+        # watch the directory instead of the file
+        self.inotify = Inotify(os.path.dirname(os.path.abspath(config_file)),
+                               IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE)
+        self.config_name = os.path.basename(config_file)
+
+    def changed(self, timeout=None):
+        """Waits for the config file to change, returns False on timeout."""
+        with selectors.DefaultSelector() as selector:
+            selector.register(self.inotify, selectors.EVENT_READ)
+            while True:
+                if not selector.select(timeout):
+                    return False
+                if any(name == self.config_name for action, name in self.inotify.read()):
+                    break
+            # let the rest of the write land, and swallow its events
+            while selector.select(self.SETTLE_TIME):
+                self.inotify.read()
+        return True
+
+    def reload(self):
+        return reload_bindings(self.config_file, self.backend)
+
+    def run(self):
+        while True:
+            self.changed()
+            self.reload()
+
+
+class FocusTracker(threading.Thread):
+    """Switches BINDINGS to the profile of the focused window.
+
+    Has its own X connection and sleeps until the window manager announces a
+    new active window (_NET_ACTIVE_WINDOW on the root window), so the tablets
+    never ask X anything. The class and name of every window that had the
+    focus are cached until it is destroyed, and its name is refreshed when it
+    changes.
+    """
+
+    RECONNECT_DELAY = 1.0
+    RECONNECT_DELAY_MAX = 30.0
+
+    def __init__(self):
+        super(FocusTracker, self).__init__(name='FocusTracker')
+        self.lock = threading.Lock()
+        self.bindings = CONFIG_BINDINGS
+        # (class, instance, name) of the focused window, None if unknown
+        self.focused = None
+        self.profile = None
+        # window -> (class, instance, name)
+        self.windows = {}
+        self.display = None
+        self.dead = False
+        self.on_io_error = X_IO_ERROR_EXIT_HANDLER(lambda display, data: setattr(self, 'dead', True))
+
+    def apply(self, bindings=None):
+        """Makes BINDINGS the profile of the focused window, from new bindings if given."""
+        global BINDINGS, CONFIG_BINDINGS
+        with self.lock:
+            if bindings is not None:
+                CONFIG_BINDINGS = self.bindings = bindings
+            name, BINDINGS = select_profile(self.bindings, self.focused)
+            if name != self.profile:
+                log(INFO, "Switched profile", profile=name or 'default')
+                self.profile = name
+
+    def connect(self):
+        xlib = load_xlib()
+        self.display = xlib.XOpenDisplay(None)
+        if not self.display:
+            self.display = None
+            raise OSError("could not open display %s" % (os.getenv('DISPLAY'),))
+        self.dead = False
+        # unlike Xlib's own handlers, don't exit() on errors: windows can be
+        # gone by the time they are looked at, and X can go away
+        xlib.XSetErrorHandler(X_IGNORE_ERRORS)
+        if hasattr(xlib, 'XSetIOErrorExitHandler'):
+            xlib.XSetIOErrorExitHandler(self.display, self.on_io_error, None)
+        self.root = xlib.XDefaultRootWindow(self.display)
+        self.atoms = {name: xlib.XInternAtom(self.display, name, False)
+                      for name in (b'_NET_ACTIVE_WINDOW', b'_NET_WM_NAME')}
+        xlib.XSelectInput(self.display, self.root, PROPERTY_CHANGE_MASK)
+
+    def disconnect(self):
+        XLIB.XCloseDisplay(self.display)
+        self.display = None
+        self.windows.clear()
+
+    def get_property(self, window, atom, length):
+        """Returns (format, data) of a window property, or (0, None) if it isn't set."""
+        actual_type = ctypes.c_ulong()
+        actual_format = ctypes.c_int()
+        items = ctypes.c_ulong()
+        remaining = ctypes.c_ulong()
+        data = ctypes.c_void_p()
+        if XLIB.XGetWindowProperty(self.display, window, atom, 0, length, False, ANY_PROPERTY_TYPE,
+                                   actual_type, actual_format, items, remaining, data) != 0:
+            return 0, None
+        try:
+            if not data or not items.value:
+                return 0, None
+            if actual_format.value == 32:
+                # format 32 properties come as an array of C longs
+                return 32, ctypes.cast(data, ctypes.POINTER(ctypes.c_ulong))[0]
+            return actual_format.value, ctypes.string_at(data, items.value * actual_format.value // 8)
+        finally:
+            if data:
+                XLIB.XFree(data)
+
+    def active_window(self):
+        format, window = self.get_property(self.root, self.atoms[b'_NET_ACTIVE_WINDOW'], 1)
+        if format != 32 or not window:
+            return None
+        return window
+
+    def describe(self, window):
+        """Returns the lower case (class, instance, name) of window."""
+        hint = XClassHint()
+        window_class = window_instance = ''
+        if XLIB.XGetClassHint(self.display, window, hint):
+            if hint.res_class:
+                window_class = ctypes.string_at(hint.res_class).decode('utf-8', 'replace').lower()
+                XLIB.XFree(hint.res_class)
+            if hint.res_name:
+                window_instance = ctypes.string_at(hint.res_name).decode('utf-8', 'replace').lower()
+                XLIB.XFree(hint.res_name)
+        window_name = ''
+        for atom in (self.atoms[b'_NET_WM_NAME'], XA_WM_NAME):
+            format, name = self.get_property(window, atom, 1024)
+            if format == 8:
+                window_name = name.decode('utf-8', 'replace').lower()
+                break
+        return window_class, window_instance, window_name
+
+    def focus(self, window):
+        if window is None:
+            focused = None
+        else:
+            focused = self.windows.get(window)
+            if focused is None:
+                # hear about it being renamed or destroyed
+                XLIB.XSelectInput(self.display, window, PROPERTY_CHANGE_MASK | STRUCTURE_NOTIFY_MASK)
+                focused = self.windows[window] = self.describe(window)
+        log(DEBUG, "Focused window", window=window, window_class=focused and focused[0],
+            name=focused and focused[2])
+        with self.lock:
+            self.focused = focused
+        self.apply()
+
+    def watch(self):
+        """Follows the focus until the X connection breaks."""
+        event = XEvent()
+        names = (self.atoms[b'_NET_WM_NAME'], XA_WM_NAME)
+        window = self.active_window()
+        self.focus(window)
+        with selectors.DefaultSelector() as selector:
+            selector.register(XLIB.XConnectionNumber(self.display), selectors.EVENT_READ)
+            while not self.dead:
+                changed = False
+                while XLIB.XPending(self.display) and not self.dead:
+                    XLIB.XNextEvent(self.display, event)
+                    if event.type == PROPERTY_NOTIFY:
+                        if event.xproperty.window == self.root:
+                            changed |= event.xproperty.atom == self.atoms[b'_NET_ACTIVE_WINDOW']
+                        elif event.xproperty.atom in names:
+                            self.windows.pop(event.xproperty.window, None)
+                            changed |= event.xproperty.window == window
+                    elif event.type == DESTROY_NOTIFY:
+                        self.windows.pop(event.xproperty.window, None)
+                if changed and not self.dead:
+                    window = self.active_window()
+                    self.focus(window)
+                # the round-trips in focus() leave whatever arrived meanwhile
+                # in Xlib's queue, where select() can't see it
+                if not self.dead and not XLIB.XPending(self.display):
+                    selector.select()
+
+    def run(self):
+        delay = self.RECONNECT_DELAY
+        while True:
+            try:
+                self.connect()
+            except OSError as e:
+                log(WARNING, "Could not connect to X to follow the focused window", error=e, retry=delay)
+                time.sleep(delay)
+                delay = min(delay * 2, self.RECONNECT_DELAY_MAX)
+                continue
+            delay = self.RECONNECT_DELAY
+            try:
+                self.watch()
+            finally:
+                self.disconnect()
+            log(WARNING, "Lost the X connection, using the default bindings until it is back")
+            self.focus(None)
+            time.sleep(delay)
+
+
+def log(level, message, **fields):
+    """Logs message with fields appended as key=value pairs.
+
+    Does nothing but compare the level if it's disabled.
+    """
+    if LOG.isEnabledFor(level):
+        LOG.log(level, message, extra={'fields': fields})
+
+
+class StructuredFormatter(logging.Formatter):
+    """Formats records as "time LEVEL message key=value ...".
+
+    Values with spaces in them are quoted, key sequences are decoded.
+    """
+
+    def __init__(self):
+        super(StructuredFormatter, self).__init__('%(asctime)s %(levelname)s %(message)s')
+
+    def formatMessage(self, record):
+        line = super(StructuredFormatter, self).formatMessage(record)
+        for key, value in getattr(record, 'fields', {}).items():
+            if isinstance(value, bytes):
+                value = value.decode('utf-8', 'replace')
+            value = str(value)
+            if not value or ' ' in value or '"' in value:
+                value = '"%s"' % (value.replace('\\', '\\\\').replace('"', '\\"'),)
+            line += ' %s=%s' % (key, value)
+        return line
+
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    """Hands records to a writer thread through a bounded queue.
+
+    Records are formatted by the writer, not by the thread that logs them,
+    and are dropped and counted instead of blocking when the queue is full.
+    """
+
+    dropped = 0
+
+    def prepare(self, record):
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+class LogWriter(logging.handlers.QueueListener):
+    """Writes the records of a DroppingQueueHandler from its own thread."""
+
+    def enqueue_sentinel(self):
+        # wait for room instead of failing when stopping with a full queue
+        self.queue.put(self._sentinel)
+
+    def handle(self, record):
+        super(LogWriter, self).handle(record)
+        dropped, LOG_HANDLER.dropped = LOG_HANDLER.dropped, 0
+        if dropped:
+            super(LogWriter, self).handle(LOG.makeRecord(
+                LOG.name, WARNING, __file__, 0, "Logging fell behind, dropped messages",
+                (), None, extra={'fields': {'count': dropped}}))
+
+
+def setup_logging(level, stream=None):
+    """Sends LOG to stream (stderr by default) through a background LogWriter."""
+    global LOG_HANDLER
+    log_queue = queue.Queue(LOG_QUEUE_SIZE)
+    LOG_HANDLER = DroppingQueueHandler(log_queue)
+    output = logging.StreamHandler(stream)
+    output.setFormatter(StructuredFormatter())
+    writer = LogWriter(log_queue, output)
+    LOG.addHandler(LOG_HANDLER)
+    LOG.setLevel(level)
+    LOG.propagate = False
+    writer.start()
+    atexit.register(writer.stop)
+    return writer
 
 
 def make_rules():
@@ -289,4 +3353,4 @@ dial_ccw=equal
 
 
 if __name__ == "__main__":
-    main()
+    sys.exit(main())
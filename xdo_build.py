@@ -1,15 +1,125 @@
 #!/usr/bin/env python3
-from cffi import FFI
+"""Builds the _xdo_cffi and _huion_filter extensions used by huion_keys.py.
 
-ffibuilder = FFI()
+By default only the part of the API that this project uses is compiled in:
+the cdef below is trimmed down to the functions and constants that
+huion_keys.py and xdo_test.py use through `lib.`, plus the types they need.
+Pass --full to build the whole libxdo API instead.
 
-# Most of the code in this cdef call was copied from xdo.h from xdotool, which
+_huion_filter is a small C pre-filter for tablet reports. It needs nothing
+but a C compiler, so it is built first and on its own with --filter-only.
+huion_keys.py decodes reports in Python if it isn't there.
+
+A build is skipped if the extension was already built from the same cdef,
+source, xdo.h, compiler and Python.
+"""
+import os
+import re
+import sys
+import glob
+import shutil
+import hashlib
+import argparse
+import sysconfig
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+# files whose use of lib.<name> decides what goes into the trimmed cdef
+PROJECT_FILES = ['huion_keys.py', 'xdo_test.py']
+MODULE_NAME = '_xdo_cffi'
+SOURCE = """
+     #include "xdo.h"   // the C header of the library
+"""
+LIBRARIES = ['xdo', 'X11']   # library names, for the linker
+# records what the current extension was built from
+STAMP_FILE = os.path.join(HERE, MODULE_NAME + '.stamp')
+
+FILTER_MODULE_NAME = '_huion_filter'
+FILTER_STAMP_FILE = os.path.join(HERE, FILTER_MODULE_NAME + '.stamp')
+# huion_filter() walks the 12 byte reports in buffer[start:end] and writes one
+# code to out for every report that huion_keys.ReportDecoder would turn into
+# events: (changed button mask << 16 | button mask) for button reports, or
+# one of the HUION_FILTER_* codes for the strip and dial. The codes are the
+# indexes of huion_keys.FILTER_EVENTS. out needs room for one code per report.
+FILTER_CDEF = """
+typedef struct {
+    uint16_t buttons;  /* button mask of the last button report */
+    uint8_t strip;     /* last strip position, 0 if no finger is on it */
+} huion_filter_state;
+
+size_t huion_filter(huion_filter_state *state, const uint8_t *buffer,
+                    size_t start, size_t end, uint32_t *out);
+"""
+FILTER_SOURCE = """
+#include <stddef.h>
+#include <stdint.h>
+
+#define HUION_REPORT_SIZE 12
+#define HUION_FILTER_STRIP_UP 1
+#define HUION_FILTER_STRIP_DOWN 2
+#define HUION_FILTER_DIAL_CW 3
+#define HUION_FILTER_DIAL_CCW 4
+
+typedef struct {
+    uint16_t buttons;
+    uint8_t strip;
+} huion_filter_state;
+
+size_t huion_filter(huion_filter_state *state, const uint8_t *buffer,
+                    size_t start, size_t end, uint32_t *out)
+{
+    uint16_t buttons = state->buttons;
+    uint8_t strip = state->strip;
+    size_t count = 0;
+    size_t i;
+
+    for (i = start; i + HUION_REPORT_SIZE <= end; i += HUION_REPORT_SIZE) {
+        const uint8_t *report = buffer + i;
+        uint8_t value = report[5];
+        /* byte 1 is the report type, pen reports and anything unknown are skipped */
+        switch (report[1]) {
+        case 0xe0: {
+            /* buttons 1-8 are the bits of byte 4 and buttons 9-16 the bits of byte 5 */
+            uint16_t mask = (uint16_t)(report[4] | value << 8);
+            uint16_t changed = mask ^ buttons;
+            if (changed) {
+                buttons = mask;
+                out[count++] = (uint32_t)changed << 16 | mask;
+            }
+            break;
+        }
+        case 0xf0:
+            /* the strip is numbered from top to bottom, 0 is the finger lifting off */
+            if (value == 0 || strip == 0) {
+                strip = value;
+            } else if (value > strip) {
+                strip = value;
+                out[count++] = HUION_FILTER_STRIP_DOWN;
+            } else if (value < strip) {
+                strip = value;
+                out[count++] = HUION_FILTER_STRIP_UP;
+            }
+            break;
+        case 0xf1:
+            if (value == 0x01)
+                out[count++] = HUION_FILTER_DIAL_CW;
+            else if (value == 0xff)
+                out[count++] = HUION_FILTER_DIAL_CCW;
+            break;
+        }
+    }
+    state->buttons = buttons;
+    state->strip = strip;
+    return count;
+}
+"""
+
+# Most of the code in this cdef was copied from xdo.h from xdotool, which
 # is available under the 3-clause BSD license. Find the original code and
 # license at: https://github.com/jordansissel/xdotool
 #
 # The lines marked "copied from X.h" and "copied from "Xlib.h" were adapted
 # from X.org code.
-ffibuilder.cdef("""
+FULL_CDEF = """
 
 /**
  * @mainpage
@@ -40,6 +150,18 @@ struct _XDisplay;
 typedef struct _XDisplay Display;
 struct Screen;
 
+// Xlib functions used to resolve key sequences ahead of time, and to notice
+// when the keyboard mapping changes
+#define NoSymbol ...
+#define MappingNotify ...
+typedef struct { int type; ...; } XMappingEvent;
+typedef union { int type; XMappingEvent xmapping; ...; } XEvent;
+KeySym XStringToKeysym(const char *string);
+KeyCode XKeysymToKeycode(Display *display, KeySym keysym);
+int XPending(Display *display);
+int XNextEvent(Display *display, XEvent *event_return);
+int XRefreshKeyboardMapping(XMappingEvent *event_map);
+
 // based on types.h
 typedef uint32_t useconds_t;
 
@@ -908,13 +1030,165 @@ int xdo_has_feature(xdo_t *xdo, int feature);
  */
 int xdo_get_viewport_dimensions(xdo_t *xdo, unsigned int *width,
                                 unsigned int *height, int screen);
-""")
-
-ffibuilder.set_source("_xdo_cffi",
 """
-     #include "xdo.h"   // the C header of the library
-""",
-     libraries=['xdo'])   # library name, for the linker
+
+
+def split_declarations(cdef):
+    """Splits a cdef into its top-level declarations, without comments."""
+    cdef = re.sub(r'/\*.*?\*/', '', cdef, flags=re.S)
+    cdef = re.sub(r'//[^\n]*', '', cdef)
+    declarations = []
+    rest = []
+    for line in cdef.split('\n'):
+        if line.strip().startswith('#'):
+            declarations.append(line.strip())
+        else:
+            rest.append(line)
+    depth = 0
+    current = ''
+    for char in '\n'.join(rest):
+        current += char
+        if char == '{':
+            depth += 1
+        elif char == '}':
+            depth -= 1
+        elif char == ';' and depth == 0:
+            declarations.append(' '.join(current.split()))
+            current = ''
+    return declarations
+
+
+def declared_names(declaration):
+    """Returns the names of the things a declaration from split_declarations() declares."""
+    if declaration.startswith('#define'):
+        return {declaration.split()[1]}
+    names = set()
+    if declaration.startswith('typedef') or '(' not in declaration:
+        # the typedef name, or the tag of "struct name;"
+        names.add(re.findall(r'\w+', declaration)[-1])
+        # struct, union and enum tags, and enumerators
+        names.update(re.findall(r'(?:struct|union|enum)\s+(\w+)\s*\{', declaration))
+        for enum_body in re.findall(r'enum\s*\w*\s*\{([^}]*)\}', declaration):
+            names.update(re.findall(r'(\w+)\s*(?:=[^,]*)?(?:,|$)', enum_body.strip()))
+    else:
+        # a function, named right before its argument list
+        names.add(re.match(r'[^(]*?(\w+)\s*\(', declaration).group(1))
+    return names
+
+
+def used_symbols(paths):
+    """Returns every name used as lib.<name> in the given source files."""
+    symbols = set()
+    for path in paths:
+        with open(os.path.join(HERE, path)) as source:
+            symbols.update(re.findall(r'\blib\.(\w+)', source.read()))
+    return symbols
+
+
+def trim_cdef(cdef, symbols):
+    """Returns the part of cdef that declares symbols and the types they depend on."""
+    declarations = split_declarations(cdef)
+    defined_by = {}
+    for index, declaration in enumerate(declarations):
+        for name in declared_names(declaration):
+            defined_by.setdefault(name, []).append(index)
+    missing = sorted(symbol for symbol in symbols if symbol not in defined_by)
+    if missing:
+        raise SystemExit("not declared in the cdef: %s" % (', '.join(missing),))
+    keep = set()
+    pending = list(symbols)
+    while pending:
+        for index in defined_by.get(pending.pop(), ()):
+            if index not in keep:
+                keep.add(index)
+                pending.extend(re.findall(r'\w+', declarations[index]))
+    # keep the original order, types have to come before their use
+    return '\n'.join(declaration for index, declaration in enumerate(declarations)
+                     if index in keep) + '\n'
+
+
+def find_header(name):
+    """Returns the path of a C header in the usual include directories, or None."""
+    directories = []
+    for variable in ('CPATH', 'C_INCLUDE_PATH'):
+        directories.extend(filter(None, os.environ.get(variable, '').split(':')))
+    directories += ['/usr/local/include', '/usr/include'] + glob.glob('/usr/include/*-linux-gnu')
+    for directory in directories:
+        path = os.path.join(directory, name)
+        if os.path.isfile(path):
+            return path
+    return None
+
+
+def build_hash(cdef, source=SOURCE, libraries=LIBRARIES, header='xdo.h'):
+    """Hashes everything an extension is built from."""
+    import cffi
+    digest = hashlib.sha256()
+    compiler = os.environ.get('CC') or sysconfig.get_config_var('CC') or 'cc'
+    compiler_path = shutil.which(compiler.split()[0])
+    header = header and find_header(header)
+    parts = [cdef, source, repr(libraries), sys.version, cffi.__version__, compiler,
+             compiler_path or '', os.environ.get('CFLAGS', ''), os.environ.get('LDFLAGS', '')]
+    if compiler_path:
+        parts.append(repr(os.stat(compiler_path).st_mtime_ns))
+    for part in parts:
+        digest.update(part.encode('utf-8') + b'\0')
+    if header:
+        with open(header, 'rb') as f:
+            digest.update(f.read())
+    return digest.hexdigest()
+
+
+def up_to_date(digest, stamp_file=STAMP_FILE):
+    """Returns whether the extension on disk was built from digest."""
+    try:
+        with open(stamp_file) as stamp:
+            built_digest, extension = stamp.read().split()
+    except (OSError, ValueError):
+        return False
+    return built_digest == digest and os.path.isfile(extension)
+
+
+def make_ffibuilder(cdef, module_name=MODULE_NAME, source=SOURCE, libraries=LIBRARIES):
+    from cffi import FFI
+    ffibuilder = FFI()
+    ffibuilder.cdef(cdef)
+    ffibuilder.set_source(module_name, source, libraries=libraries)
+    return ffibuilder
+
+
+def build(module_name, cdef, source, libraries, header, stamp_file, force):
+    """Compiles an extension next to this script unless it is up to date."""
+    digest = build_hash(cdef, source, libraries, header)
+    if not force and up_to_date(digest, stamp_file):
+        print("%s is up to date" % (module_name,))
+        return
+    os.chdir(HERE)
+    extension = make_ffibuilder(cdef, module_name, source, libraries).compile(verbose=True)
+    with open(stamp_file, 'w') as stamp:
+        stamp.write('%s %s\n' % (digest, os.path.abspath(extension)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Build the _xdo_cffi and _huion_filter extensions.')
+    parser.add_argument('--full', action='store_true', default=False,
+                    help='build the whole libxdo API instead of only what this project uses')
+    parser.add_argument('--force', action='store_true', default=False,
+                    help='build even if nothing changed since the last build')
+    parser.add_argument('--print-cdef', action='store_true', default=False,
+                    help='print the cdef that would be built and exit')
+    parser.add_argument('--filter-only', action='store_true', default=False,
+                    help='only build the report pre-filter, for --output uinput without libxdo')
+    args = parser.parse_args()
+    cdef = FULL_CDEF if args.full else trim_cdef(FULL_CDEF, used_symbols(PROJECT_FILES))
+    if args.print_cdef:
+        print(cdef)
+        return 0
+    build(FILTER_MODULE_NAME, FILTER_CDEF, FILTER_SOURCE, [], None, FILTER_STAMP_FILE, args.force)
+    if not args.filter_only:
+        build(MODULE_NAME, cdef, SOURCE, LIBRARIES, 'xdo.h', STAMP_FILE, args.force)
+    return 0
+
 
 if __name__ == "__main__":
-    ffibuilder.compile(verbose=True)
+    sys.exit(main())